@@ -9,50 +9,76 @@
 #
 from bokeh.plotting import figure
 from bokeh.io import output_notebook, show
-from bokeh.models import CheckboxGroup, CustomJS, Panel, Tabs, Div
+from bokeh.models import CheckboxGroup, ColumnDataSource, CustomJS, Panel, Tabs, Div
 from bokeh.layouts import row
 from bokeh.palettes import brewer
 
 from ipy_table import make_table, set_global_style, set_cell_style
 from IPython.display import HTML, display
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import sqlite3
 import sys
-import urllib.request
 import urllib.parse
 import os.path
-import csv
-import itertools
+import io
+import hashlib
 import math
 
 import lxml.html
-import yaml
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from csvyreader import isodate, parse_all, parse_fields, sha256sum
+from downloader import DownloadCache
 
 assert(sys.version_info.major == 3) # Python3 only!
 
-def webscraping(use_cache=True):
-    'A generator to fetch all CSVY files of 2016 LegCo rolling data from HKU POP'
+def webscraping(use_cache=True, cache=None, master=False):
+    '''A generator to fetch all CSVY files of 2016 LegCo rolling data from HKU POP as file objects
+
+    Without use_cache, files are refreshed into a DownloadCache (default: current
+    dir) so only changed files are transferred; check cache.status afterwards
+    for which files are new or changed. The master file of all cases is skipped
+    unless master is set'''
     # XPath 2.0 is not supported, so use substring() instead of ends-with()
     if not use_cache:
+        if cache is None:
+            cache = DownloadCache('.')
         main_url = 'http://data.hkupop.hku.hk/v2/hkupop/lc_election/ch.html'
         xpath = "//a[text()='下載']/@href[substring(.,string-length(.)-string-length('.csvy')+1)='.csvy']"
-        text = urllib.request.urlopen(main_url).read().decode('utf-8')
+        text = cache.fetcher.fetch(main_url)
         dom = lxml.html.document_fromstring(text)
         csvyurls = [urllib.parse.urljoin(main_url,relurl) for relurl in dom.xpath(xpath)]
-        for url in reversed(csvyurls):
-            if 'lc2016_rolling' not in url: continue # prevent mistake
-            yield url, urllib.request.urlopen(url).read().decode('utf-8')
+        csvyurls = [url for url in reversed(csvyurls) if 'lc2016_rolling' in url] # prevent mistake
+        csvyurls = [url for url in csvyurls if master or 'master' not in url]
+        for url, text in cache.fetch_all(csvyurls):
+            yield url, io.StringIO(text, newline='')
     else:
         for f in reversed(sorted(os.listdir("."))):
-            if 'master' in f: continue
+            if 'master' in f and not master: continue
             if 'LC2016_final_' not in f: continue
-            yield f, open(f, encoding='utf-8').read()
+            with open(f, encoding='utf-8', newline='') as fileobj:
+                yield f, fileobj
 
 def deduce_name(url):
     "Deduce filename from URL"
     return os.path.basename(urllib.parse.urlsplit(url).path).rsplit('.',1)[0]
 
+def error_margins(z, n, p):
+    '''Margins of error z*sqrt(p*(100-p)/n) of lists of sample sizes n and
+    percentages p, in one pass with NumPy if available; None where n is not
+    positive '''
+    if numpy is None:
+        return [z*math.sqrt(pp*(100.0-pp)/nn) if nn is not None and nn > 0 else None for nn, pp in zip(n, p)]
+    nn = numpy.array(n, dtype=numpy.float64)
+    pp = numpy.array(p, dtype=numpy.float64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        margin = z*numpy.sqrt(pp*(100.0-pp)/nn)
+    return [m if k > 0 else None for m, k in zip(margin.tolist(), nn.tolist())]
+
 def redness(cur):
     "Add the redness table"
     data = [
@@ -151,126 +177,452 @@ def redness(cur):
         ,['NTEast',    21,  0.8, '新民黨 容海恩']
         ,['NTEast',    22,  1.0, '民建聯 陳克勤']
     ]
-    cur.execute("CREATE TABLE redness(region,num,redness,who)")
+    cur.execute("CREATE TABLE IF NOT EXISTS redness(region,num,redness,who)")
     cur.executemany("INSERT INTO redness(region,num,redness,who) VALUES(?,?,?,?)", data)
 
-def buildsqlite(dbname=':memory:', use_cache=False):
-    " Produce cursor to SQLite holding all latest data from HKUPOP "
-    columns = ['sourcefile']
-    data = []
-    answer = []
-    # work on each URL, gather all data
-    for url, csvy in webscraping(use_cache):
+def buildsqlite(dbname=':memory:', use_cache=False, incremental=False, jobs=1, cachedir=None, bulk=False):
+    ''' Produce cursor to SQLite holding all latest data from HKUPOP
+
+    With incremental, an existing database is updated instead of rebuilt: the
+    manifest table remembers the content hash of each ingested sourcefile, and
+    only new or changed files are inserted to poll and aggregated to overall
+
+    With jobs > 1, files are parsed in that many worker processes while this
+    process writes to the database in the same order as with jobs=1
+
+    With cachedir, parsed files are kept there in binary columnar format and
+    memory-mapped instead of parsed again in later runs
+
+    Margins of error of weighted shares are stored twice: adj_err and
+    valid_adj_err take the sum of weights as sample size, while
+    adj_err_kish and valid_adj_err_kish take Kish's effective sample size
+    (sum of weights)^2/(sum of squared weights), stored as adj_neff and
+    valid_adj_neff
+
+    With bulk, rows are loaded in one explicit transaction with journal in
+    memory and no fsync, which are restored afterwards. The index on poll is
+    built after loading, followed by ANALYZE '''
+    # Write to SQLite while the data is read
+    if not incremental:
+        try:
+            os.unlink(dbname)
+        except:
+            pass
+    conn = sqlite3.connect(dbname)
+    cur = conn.cursor()
+    tables = [name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if incremental and dbname != ':memory:' and tables and ('manifest' not in tables or 'respondent' in tables):
+        # built by a version without manifest, or with poll as a view over
+        # deduplicated respondents, which cannot be updated: rebuild
+        conn.close()
+        os.unlink(dbname)
+        conn = sqlite3.connect(dbname)
+        cur = conn.cursor()
+        tables = []
+    if bulk:
+        # relax durability while loading, restored after commit
+        pragmas = [(name, cur.execute("PRAGMA %s" % name).fetchone()[0]) for name in ("journal_mode", "synchronous")]
+        cur.execute("PRAGMA journal_mode=MEMORY")
+        cur.execute("PRAGMA synchronous=OFF")
+        cur.execute("BEGIN")
+    if 'manifest' not in tables:
+        cur.execute("CREATE TABLE IF NOT EXISTS answers(region,value,answer)")
+        redness(cur)
+        cur.execute("CREATE TABLE manifest(sourcefile PRIMARY KEY, sha256)")
+        cur.execute("CREATE TABLE poll(sourcefile)")
+    # index on sourcefile, built after loading in bulk mode
+    index = "CREATE INDEX IF NOT EXISTS poll_sourcefile ON poll(sourcefile)"
+    if bulk:
+        cur.execute("DROP INDEX IF EXISTS poll_sourcefile")
+    else:
+        cur.execute(index)
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(poll)")]
+    answered = bool(list(cur.execute("SELECT 1 FROM answers LIMIT 1")))
+    cur.execute("CREATE TEMP TABLE newfiles(sourcefile)")
+    ingested = False
+    def sources():
+        "Generator of new or changed files, with their old data removed"
+        for url, fileobj in webscraping(use_cache):
+            data_name = deduce_name(url)
+            sha256 = sha256sum(fileobj)
+            known = list(conn.execute("SELECT sha256 FROM manifest WHERE sourcefile=?", (data_name,)))
+            if known and known[0][0] == sha256:
+                continue # ingested before
+            if known:
+                # changed since last ingested, replace the old rows
+                conn.execute("DELETE FROM poll WHERE sourcefile=?", (data_name,))
+            if known and 'overall' in tables:
+                conn.execute("DELETE FROM overall WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+            if known and 'ranking' in tables:
+                conn.execute("DELETE FROM ranking WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+            if known and 'bootstrap' in tables:
+                conn.execute("DELETE FROM bootstrap WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+                conn.execute("DELETE FROM bootstrap_lead WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+            if known and 'seatsim' in tables:
+                conn.execute("DELETE FROM seatsim WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+                conn.execute("DELETE FROM seatsim_bloc WHERE daterange=SUBSTR(?,14,13)", (data_name,))
+            yield (url, data_name, sha256), fileobj
+    # work on each URL, stream new data into poll table
+    for (url, data_name, sha256), fields_def_yaml, header, batches in parse_all(sources(), isodate, jobs, cachedir=cachedir):
         print(url)
-        data_name = deduce_name(url)
-        lines = csvy.split("\n")
-        # Extract and parse the CSVY metadata part
-        fields_def_yaml = [ln[1:] for ln in itertools.takewhile(lambda s:s[0]=='#', lines)]
-        if not fields_def_yaml:
-            # the metadata is not in comment, look for limiters instead
-            fields_def_yaml = [ln for ln in itertools.takewhile(lambda s:not s.startswith('---'), lines[1:])]
-        else:
-            fields_def_yaml = fields_def_yaml[1:-1]
-        if not answer: # assume all are the same, so parse only the first one
-            fields_def = yaml.load("\n".join(fields_def_yaml))
-            assert('fields' in fields_def)
-            assert(all('name' in f for f in fields_def['fields']))
-            for f in fields_def['fields']:
-                if 'labels' not in f: continue
-                for answertext, code in f['labels'].items():
-                    answer.append([f['name'], int(code), answertext])
-        # Extract and parse the CSVY data part
-        csvdata = list(csv.reader([ln+'\n' for ln in lines[len(fields_def_yaml)+2:]]))
-        # parse header, and gather data
-        header = csvdata[0]
-        if len(header) < len(csvdata[1]):
-            # in case header row is shorter, align to right
-            header = ['_'+str(int(n+1)) for n in range(len(csvdata[1])-len(header))] + header
-        data += [
-            dict(zip(header, row), sourcefile=data_name) for row in csvdata[1:] if row
-        ]
+        if not answered: # assume all are the same, so parse only the first one
+            answer = [[f['name'], int(code), answertext]
+                      for f in parse_fields(fields_def_yaml) if 'labels' in f
+                      for answertext, code in f['labels'].items()]
+            cur.executemany("INSERT INTO answers(region,value,answer) VALUES(?,?,?)", answer)
+            answered = True
+        # name the padding columns of a short header
+        header = ['_'+str(n+1) if h is None else h for n,h in enumerate(header)]
         # remember all column names
         for h in header:
             if h not in columns:
                 columns.append(h)
-    # Review data, make sure all keys exist
-    for row in data:
-        for h in columns:
-            if h not in row or not row[h] or row[h] == 'NA':
-                row[h] = None
-            elif h == 'date':
-                row[h] = datetime.strptime(row[h], "%Y%m%d").strftime("%Y-%m-%d")
-            elif row[h].isdigit():
-                row[h] = int(row[h])
-            else:
-                try:
-                    row[h] = float(row[h])
-                except:
-                    pass
-    # Write to SQLite
-    try:
-        os.unlink(dbname)
-    except:
-        pass
-    def error_margin(z, n, p):
-        if n > 0:
-            return z*math.sqrt(p*(100.0-p)/float(n))
-        else:
-            return None
-    conn = sqlite3.connect(dbname)
-    conn.create_function('ERRMARGIN', 3, error_margin)
+                cur.execute("ALTER TABLE poll ADD COLUMN %s" % h)
+        columnlist = ",".join(['sourcefile'] + header)
+        paramlist = ",".join(['?'] * (len(header)+1))
+        cur.executemany("INSERT INTO poll(%s) VALUES(%s)" % (columnlist, paramlist),
+                        ((data_name,)+row for batch in batches for row in batch))
+        cur.execute("INSERT OR REPLACE INTO manifest(sourcefile, sha256) VALUES(?,?)", (data_name, sha256))
+        cur.execute("INSERT INTO newfiles(sourcefile) VALUES(?)", (data_name,))
+        ingested = True
+    if bulk:
+        cur.execute(index)
+        cur.execute("ANALYZE")
+    columns = ["region", "daterange", "window_start", "window_end", "votes",
+               "vote_pct", "vote_err", "valid_vote_pct", "valid_vote_err",
+               "adj_pct", "adj_err", "valid_adj_pct", "valid_adj_err", "num", "redness", "candid",
+               "adj_neff", "valid_adj_neff", "adj_err_kish", "valid_adj_err_kish"]
+    if 'overall' in tables and [row[1] for row in cur.execute("PRAGMA table_info(overall)")] != columns:
+        # overall was built by an older version, aggregate all sourcefiles again
+        cur.execute("DROP TABLE overall")
+        cur.execute("DROP TABLE IF EXISTS ranking")
+        tables = [t for t in tables if t not in ('overall', 'ranking')]
+        cur.execute("INSERT INTO newfiles(sourcefile) SELECT sourcefile FROM manifest "
+                    "WHERE sourcefile NOT IN (SELECT sourcefile FROM newfiles)")
+    aggregate_overall(cur, 'overall' in tables)
+    index_overall(cur, 'ranking' in tables)
+    cur.execute("DROP TABLE newfiles")
+    if ingested:
+        # build stamp, for QueryCache to notice the database has changed
+        version, = cur.execute("PRAGMA user_version").fetchone()
+        cur.execute("PRAGMA user_version=%d" % (version+1))
+    conn.commit()
+    if bulk:
+        for name, value in pragmas:
+            cur.execute("PRAGMA %s=%s" % (name, value))
+    return conn,cur
+
+def buildoverall(use_cache=False, jobs=1, cachedir=None):
+    ''' Produce cursor to in-memory SQLite holding the overall and ranking
+    tables only, aggregated with NumPy instead of SQL
+
+    Rows of poll are reduced to arrays as they are read and never stored. The
+    tables are the same as made by buildsqlite() so get_trend(), get_rank()
+    etc. work on either '''
+    from aggregator import Aggregator # requires NumPy
+    conn = sqlite3.connect(':memory:')
     cur = conn.cursor()
-    cur.execute("CREATE TABLE answers(region,value,answer)")
-    cur.executemany("INSERT INTO answers(region,value,answer) VALUES(?,?,?)", answer)
-    columnlist = ",".join(columns)
-    paramlist = ",".join(':'+c for c in columns)
     redness(cur)
-    cur.execute("CREATE TABLE poll(%s)" % columnlist)
-    cur.executemany("INSERT INTO poll(%s) VALUES(%s)" % (columnlist, paramlist), data)
-    sql = ['CREATE TABLE overall AS']
-    for region,col in [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]:
+    cur.execute("CREATE TABLE manifest(sourcefile PRIMARY KEY, sha256)")
+    def sources():
+        "Generator of files, with their hash recorded to manifest"
+        for url, fileobj in webscraping(use_cache):
+            data_name = deduce_name(url)
+            cur.execute("INSERT OR REPLACE INTO manifest(sourcefile, sha256) VALUES(?,?)", (data_name, sha256sum(fileobj)))
+            yield data_name, fileobj
+    aggregator = Aggregator()
+    for data_name, _, header, batches in parse_all(sources(), isodate, jobs, cachedir=cachedir):
+        print(data_name)
+        aggregator.add(data_name, header, batches)
+    candids = {(region, num):(red, who) for region, num, red, who in cur.execute("SELECT region, num, redness, who FROM redness")}
+    columns = ["region", "daterange", "window_start", "window_end", "votes",
+               "vote_pct", "vote_err", "valid_vote_pct", "valid_vote_err",
+               "adj_pct", "adj_err", "valid_adj_pct", "valid_adj_err", "num", "redness", "candid",
+               "adj_neff", "valid_adj_neff", "adj_err_kish", "valid_adj_err_kish"]
+    cur.execute("CREATE TABLE overall(%s)" % ",".join(columns))
+    rows = []
+    for region, sourcefile, num, votes, *values in aggregator.rows():
+        shares, kish = values[:8], values[8:]
+        daterange = sourcefile[13:26]
+        window_start = "%s-%s-%s" % (daterange[:4], daterange[4:6], daterange[6:8])
+        window_end = "%s-%s-%s" % (daterange[:4], daterange[9:11], daterange[11:13])
+        red, who = candids.get((region, 800+num if region == 'SuperDC' else num), (None, None))
+        rows.append([region, daterange, window_start, window_end, votes] + shares + [num, red, who] + kish)
+    cur.executemany("INSERT INTO overall(%s) VALUES(%s)" % (",".join(columns), ",".join("?"*len(columns))), rows)
+    index_overall(cur)
+    cur.execute("PRAGMA user_version=1")
+    conn.commit()
+    return conn,cur
+
+def buildbootstrap(cur, replicates=10000, seed=0, level=95, jobs=1):
+    ''' Add bootstrap percentile intervals of weighted shares to a database
+    made by buildsqlite()
+
+    Respondents of each region in each window are resampled with replacement
+    replicates times. Table bootstrap holds the share of each ranked candidate
+    in variants adj and valid_adj (as in ranking table) with its interval at
+    level% confidence, and bootstrap_lead holds the lead of each candidate
+    over each other with its interval. Random numbers are seeded by seed,
+    region and sourcefile, so the results are the same with any jobs. Only
+    windows not yet bootstrapped with the same parameters are computed '''
+    import numpy
+    from bootstrap import NULL, bootstrap_all # requires NumPy
+    tables = [name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if 'bootstrap' not in tables:
+        cur.execute("CREATE TABLE bootstrap(region, daterange, window_end, variant, num, pct, pct_lo, pct_hi, "
+                    "replicates, seed, level)")
+        cur.execute("CREATE TABLE bootstrap_lead(region, daterange, window_end, variant, num, rival, lead, lead_lo, lead_hi)")
+    sql = "SELECT sourcefile FROM manifest WHERE SUBSTR(sourcefile,14,13) NOT IN " \
+          "(SELECT daterange FROM bootstrap WHERE replicates=? AND seed=? AND level=?) ORDER BY sourcefile"
+    sourcefiles = [sourcefile for sourcefile, in cur.execute(sql, (replicates, seed, level))]
+    for table in ("bootstrap", "bootstrap_lead"):
+        cur.executemany("DELETE FROM %s WHERE daterange=SUBSTR(?,14,13)" % table, [(f,) for f in sourcefiles])
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(poll)")]
+    regioncols = [(code, col) for code, col in [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),
+                                                ("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")] if col in columns]
+    def windows():
+        "Generator of (key, codes, weights) of each region in each new sourcefile"
+        for sourcefile in sourcefiles:
+            rows = cur.execute("SELECT weight,%s FROM poll WHERE sourcefile=?" % ",".join(col for _,col in regioncols),
+                               (sourcefile,)).fetchall()
+            weights = numpy.array([0.0 if row[0] is None else row[0] for row in rows], dtype=numpy.float64)
+            for n, (region, _) in enumerate(regioncols, 1):
+                codes = numpy.array([NULL if row[n] is None else row[n] for row in rows], dtype=numpy.int64)
+                yield (region, sourcefile), codes, weights
+    for (region, sourcefile), shares, leads in bootstrap_all(windows(), replicates, seed, level, jobs):
+        daterange = sourcefile[13:26]
+        window_end = "%s-%s-%s" % (daterange[:4], daterange[9:11], daterange[11:13])
+        cur.executemany("INSERT INTO bootstrap VALUES(?,?,?,?,?,?,?,?,?,?,?)",
+                        [(region, daterange, window_end) + row + (replicates, seed, level) for row in shares])
+        cur.executemany("INSERT INTO bootstrap_lead VALUES(?,?,?,?,?,?,?,?,?)",
+                        [(region, daterange, window_end) + row for row in leads])
+    cur.execute("CREATE INDEX IF NOT EXISTS bootstrap_window ON bootstrap(region, window_end, variant, num)")
+    cur.execute("CREATE INDEX IF NOT EXISTS bootstrap_lead_window ON bootstrap_lead(region, window_end, variant, num, rival)")
+    cur.connection.commit()
+
+def buildseatsim(cur, simulations=100000, seed=0, jobs=1):
+    ''' Add Monte Carlo seat allocation of each window to a database with
+    overall table
+
+    Valid shares of each region are drawn around valid_adj_pct with the
+    uncertainty of valid_adj_neff respondents, and seats are allocated by
+    largest remainder with Hare quota. Table seatsim holds the mean seats and
+    the probability of winning a seat of each candidate list, and seatsim_bloc
+    the probability of each number of seats won by each bloc (sign of redness,
+    NULL for others). Random numbers are seeded by seed, region and window, so
+    the results are the same with any jobs. Only windows not yet simulated
+    with the same parameters are computed '''
+    from seatsim import simulate_all # requires NumPy
+    tables = [name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if 'seatsim' not in tables:
+        cur.execute("CREATE TABLE seatsim(region, daterange, window_end, num, candid, redness, seats_mean, win_prob, "
+                    "simulations, seed)")
+        cur.execute("CREATE TABLE seatsim_bloc(region, daterange, window_end, bloc, seats, prob)")
+    sql = "SELECT DISTINCT daterange FROM overall WHERE daterange NOT IN " \
+          "(SELECT daterange FROM seatsim WHERE simulations=? AND seed=?) ORDER BY daterange"
+    dateranges = [daterange for daterange, in cur.execute(sql, (simulations, seed))]
+    for table in ("seatsim", "seatsim_bloc"):
+        cur.executemany("DELETE FROM %s WHERE daterange=?" % table, [(d,) for d in dateranges])
+    def windows():
+        "Generator of (key, nums, pct, neff, blocs, seats) of each region in each new window"
+        for daterange in dateranges:
+            for _, region, seats in regions:
+                rows = cur.execute("SELECT num, valid_adj_pct, valid_adj_neff, redness FROM overall "
+                                   "WHERE region=? AND daterange=? AND num>0 AND num<30 AND valid_adj_pct>0 "
+                                   "ORDER BY num", (region, daterange)).fetchall()
+                if rows and rows[0][2]:
+                    nums, pct, neff, redness = zip(*rows)
+                    blocs = [0 if not r else 1 if r > 0 else -1 for r in redness]
+                    yield (region, daterange), list(nums), list(pct), neff[0], blocs, seats
+    for (region, daterange), candidates, blocs in simulate_all(windows(), simulations, seed, jobs):
+        window_end = "%s-%s-%s" % (daterange[:4], daterange[9:11], daterange[11:13])
+        cur.executemany("INSERT INTO seatsim SELECT region, daterange, window_end, num, candid, redness, ?, ?, ?, ? "
+                        "FROM overall WHERE region=? AND daterange=? AND num=?",
+                        [(mean, prob, simulations, seed, region, daterange, num) for num, mean, prob in candidates])
+        cur.executemany("INSERT INTO seatsim_bloc VALUES(?,?,?,?,?,?)",
+                        [(region, daterange, window_end, bloc or None, n, prob) for bloc, n, prob in blocs])
+    cur.execute("CREATE INDEX IF NOT EXISTS seatsim_window ON seatsim(region, window_end, num)")
+    cur.execute("CREATE INDEX IF NOT EXISTS seatsim_bloc_window ON seatsim_bloc(region, window_end, bloc, seats)")
+    cur.connection.commit()
+
+def builddaily(cur, use_cache=False, cachedir=None):
+    ''' Add daily table to a database, holding for each region, interview date
+    and answer the number of respondents (votes), sum of weights (adj) and sum
+    of squared weights (adj2) in the master file
+
+    Weights are those of the master file, and cases without weight there are
+    not counted. The table is rebuilt on every call, and the build stamp is
+    bumped for QueryCache '''
+    regioncols = [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]
+    def sources():
+        "Generator of the master file"
+        for url, fileobj in webscraping(use_cache, master=True):
+            if 'master' in deduce_name(url):
+                yield url, fileobj
+    counts = {}
+    for url, _, header, batches in parse_all(sources(), isodate, cachedir=cachedir):
+        print(url)
+        date, weight = header.index('date'), header.index('weight')
+        columns = [(region, header.index(col)) for region, col in regioncols if col in header]
+        for batch in batches:
+            for row in batch:
+                if row[weight] is None:
+                    continue
+                for region, n in columns:
+                    if row[n] is not None:
+                        count = counts.setdefault((region, row[date], row[n]), [0, 0.0, 0.0])
+                        count[0] += 1
+                        count[1] += row[weight]
+                        count[2] += row[weight]*row[weight]
+    cur.execute("DROP TABLE IF EXISTS daily")
+    cur.execute("CREATE TABLE daily(region, date, num, votes, adj, adj2)")
+    cur.executemany("INSERT INTO daily(region, date, num, votes, adj, adj2) VALUES(?,?,?,?,?,?)",
+                    [key + tuple(count) for key, count in sorted(counts.items())])
+    cur.execute("CREATE INDEX daily_region ON daily(region, date, num, votes, adj, adj2)")
+    version, = cur.execute("PRAGMA user_version").fetchone()
+    cur.execute("PRAGMA user_version=%d" % (version+1))
+    cur.connection.commit()
+
+def aggregate_overall(cur, append=False):
+    ''' Aggregate the rows of poll of the sourcefiles in temp table newfiles
+    into overall table, which is created unless append. Indexes and ranking
+    are made afterwards by index_overall() '''
+    columns = ["region", "daterange", "window_start", "window_end", "votes",
+               "vote_pct", "vote_err", "valid_vote_pct", "valid_vote_err",
+               "adj_pct", "adj_err", "valid_adj_pct", "valid_adj_err", "num", "redness", "candid",
+               "adj_neff", "valid_adj_neff", "adj_err_kish", "valid_adj_err_kish"]
+    # denominators of all regions are counted in one pass over poll, then
+    # joined to each region
+    regioncols = [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]
+    sql = ["CREATE TEMP TABLE denominators AS SELECT sourcefile"]
+    for region,col in regioncols:
+        sql += [
+                 ",COUNT(%s) AS %s_all" % (col,col)
+                ,",SUM(%s>0 AND %s<30) AS %s_valid" % (col,col,col)
+                ,",SUM(CASE WHEN %s IS NOT NULL THEN weight END) AS %s_adj" % (col,col)
+                ,",SUM(CASE WHEN %s>0 AND %s<30 THEN weight END) AS %s_valid_adj" % (col,col,col)
+                ,",SUM(CASE WHEN %s IS NOT NULL THEN weight*weight END) AS %s_adj2" % (col,col)
+                ,",SUM(CASE WHEN %s>0 AND %s<30 THEN weight*weight END) AS %s_valid_adj2" % (col,col,col)
+        ]
+    sql += ["FROM poll WHERE sourcefile IN (SELECT sourcefile FROM newfiles) GROUP BY sourcefile"]
+    cur.execute(' '.join(sql))
+    cur.execute("CREATE UNIQUE INDEX temp.denominators_sourcefile ON denominators(sourcefile)")
+    # sample sizes are put in the err columns, replaced by margins afterwards
+    sql = ['INSERT INTO overall(%s)' % ",".join(columns) if append else 'CREATE TABLE overall AS']
+    for region,col in regioncols:
         sql += [
             "SELECT"
                 ,"'%s' AS region," % region
                 ,"SUBSTR(X.sourcefile,14,13) AS daterange,"
+                ,"SUBSTR(X.sourcefile,14,4)||'-'||SUBSTR(X.sourcefile,18,2)||'-'||SUBSTR(X.sourcefile,20,2) AS window_start,"
+                ,"SUBSTR(X.sourcefile,14,4)||'-'||SUBSTR(X.sourcefile,23,2)||'-'||SUBSTR(X.sourcefile,25,2) AS window_end,"
                 ,"COUNT(*) AS votes,"
-                ,"COUNT(*)*100.0/(SELECT COUNT(*) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS vote_pct,"
-                ,"(SELECT COUNT(*) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS vote_err,"
-                ,"COUNT(*)*100.0/(SELECT COUNT(*) FROM poll WHERE",col,">0 AND",col,"<30 AND sourcefile=X.sourcefile) AS valid_vote_pct,"
-                ,"(SELECT COUNT(*) FROM poll WHERE",col,">0 AND",col,"<30 AND sourcefile=X.sourcefile) AS valid_vote_err,"
-                ,"SUM(X.weight)*100.0/(SELECT SUM(weight) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS adj_pct,"
-                ,"(SELECT SUM(weight) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS adj_err,"
-                ,"SUM(X.weight)*100.0/(SELECT SUM(weight) FROM poll WHERE",col,">0 AND",col,"<30 AND sourcefile=X.sourcefile) AS valid_adj_pct,"
-                ,"(SELECT SUM(weight) FROM poll WHERE",col,">0 AND",col,"<30 AND sourcefile=X.sourcefile) AS valid_adj_err,"
+                ,"COUNT(*)*100.0/D.%s_all AS vote_pct," % col
+                ,"D.%s_all AS vote_err," % col
+                ,"COUNT(*)*100.0/D.%s_valid AS valid_vote_pct," % col
+                ,"D.%s_valid AS valid_vote_err," % col
+                ,"SUM(X.weight)*100.0/D.%s_adj AS adj_pct," % col
+                ,"D.%s_adj AS adj_err," % col
+                ,"SUM(X.weight)*100.0/D.%s_valid_adj AS valid_adj_pct," % col
+                ,"D.%s_valid_adj AS valid_adj_err," % col
                 ,col, "AS num,"
                 ,"Y.redness AS redness,"
-                ,"Y.who AS candid"
-            ,("FROM poll X LEFT JOIN redness Y ON Y.region='%s' AND Y.num=X.%s" if region!='SuperDC' else
-              "FROM poll X LEFT JOIN redness Y ON Y.region='%s' AND Y.num=800+X.%s"
+                ,"Y.who AS candid,"
+                ,"D.{c}_adj*D.{c}_adj/D.{c}_adj2 AS adj_neff,".format(c=col)
+                ,"D.{c}_valid_adj*D.{c}_valid_adj/D.{c}_valid_adj2 AS valid_adj_neff,".format(c=col)
+                ,"D.{c}_adj*D.{c}_adj/D.{c}_adj2 AS adj_err_kish,".format(c=col)
+                ,"D.{c}_valid_adj*D.{c}_valid_adj/D.{c}_valid_adj2 AS valid_adj_err_kish".format(c=col)
+            ,"FROM poll X JOIN denominators D ON D.sourcefile=X.sourcefile"
+            ,("LEFT JOIN redness Y ON Y.region='%s' AND Y.num=X.%s" if region!='SuperDC' else
+              "LEFT JOIN redness Y ON Y.region='%s' AND Y.num=800+X.%s"
               )% (region,col)
-            ,"WHERE X."+col, "IS NOT NULL GROUP BY X.sourcefile, X."+col
+            ,"WHERE X."+col, "IS NOT NULL"
+            ,"GROUP BY X.sourcefile, X."+col
             ,"UNION ALL"
         ]
     cur.execute(' '.join(sql[:-1]))
-    sql = [
-        'UPDATE overall SET',
-                'vote_err=ERRMARGIN(1.96, vote_err, vote_pct),',
-          'valid_vote_err=ERRMARGIN(1.96, valid_vote_err, valid_vote_pct),',
-                 'adj_err=ERRMARGIN(1.96, adj_err, adj_pct),',
-           'valid_adj_err=ERRMARGIN(1.96, valid_adj_err, valid_adj_pct)',
+    # margins of error at 95% confidence, in one pass over the new rows
+    errs = ["vote_err", "valid_vote_err", "adj_err", "valid_adj_err", "adj_err_kish", "valid_adj_err_kish"]
+    pcts = ["vote_pct", "valid_vote_pct", "adj_pct", "valid_adj_pct", "adj_pct", "valid_adj_pct"]
+    rows = list(cur.execute("SELECT rowid, %s FROM overall WHERE daterange IN (SELECT SUBSTR(sourcefile,14,13) FROM newfiles)"
+                            % ",".join(errs+pcts)))
+    if rows:
+        rowids, *values = zip(*rows)
+        margins = [error_margins(1.96, values[n], values[len(errs)+n]) for n in range(len(errs))]
+        cur.executemany("UPDATE overall SET %s WHERE rowid=?" % ",".join(e+"=?" for e in errs), zip(*margins, rowids))
+    cur.execute("DROP TABLE denominators")
+
+def index_overall(cur, new_only=False):
+    ''' Build the indexes of overall table and rank its rows into ranking table
+
+    With new_only, only the windows of sourcefiles in temp table newfiles are
+    ranked and appended to the existing ranking table '''
+    # covering indexes for get_trend() and get_rank()
+    values = "daterange, candid, redness, vote_pct, vote_err, valid_vote_pct, valid_vote_err, " \
+             "adj_pct, adj_err, valid_adj_pct, valid_adj_err, adj_err_kish, valid_adj_err_kish"
+    cur.execute("CREATE INDEX IF NOT EXISTS overall_trend ON overall(region, num, window_end, %s)" % values)
+    cur.execute("CREATE INDEX IF NOT EXISTS overall_rank ON overall(region, window_end, num, %s)" % values)
+    # rank the candidates of each new window in each variant of share, where
+    # seat_gap is the lead over first loser for the seated, or the deficit to
+    # the last seat for the others, and threshold_gap is the lead over the
+    # safe threshold 100/(seats+1). Undecided (8888) is kept but not ranked.
+    # err_kish is the margin with effective sample size, same as err if raw
+    cur.execute("CREATE TEMP TABLE seats(region PRIMARY KEY, seats)")
+    cur.executemany("INSERT INTO seats(region, seats) VALUES(?,?)", [(code, seats) for _,code,seats in regions])
+    columns = ["region", "daterange", "window_end", "variant", "num", "candid", "redness", "pct", "err", "err_kish",
+               "rank", "bloc", "bloc_rank", "seat_gap", "threshold_gap"]
+    sql = ['INSERT INTO ranking(%s)' % ",".join(columns) if new_only else 'CREATE TABLE ranking AS']
+    sql += ["WITH shares AS ("]
+    for variant in ["valid_adj", "adj", "valid_vote", "vote"]:
+        sql += [
+            "SELECT region, daterange, window_end, num, candid, redness,"
+                ,"'%s' AS variant, %s_pct AS pct, %s_err AS err," % (variant, variant, variant)
+                ,"%s_err%s AS err_kish," % (variant, "_kish" if variant.endswith("adj") else "")
+                ,"CASE WHEN redness<0 THEN -1 WHEN redness>0 THEN 1 END AS bloc"
+            ,"FROM overall WHERE", "num<30" if variant.startswith("valid_") else "(num<30 OR num=8888)"
+            ,"AND daterange IN (SELECT SUBSTR(sourcefile,14,13) FROM newfiles)" if new_only else ""
+            ,"UNION ALL"
+        ]
+    sql[-1] = "), ranked AS ("
+    sql += [
+        "SELECT X.*, S.seats,"
+            ,"CASE WHEN num<30 THEN ROW_NUMBER() OVER (PARTITION BY X.region, window_end, variant, num<30 ORDER BY pct DESC, num) END AS rank,"
+            ,"CASE WHEN bloc IS NOT NULL THEN ROW_NUMBER() OVER (PARTITION BY X.region, window_end, variant, bloc ORDER BY pct DESC, num) END AS bloc_rank"
+        ,"FROM shares X JOIN seats S ON S.region=X.region"
+        ,")"
+        ,"SELECT R.region, R.daterange, R.window_end, R.variant, R.num, R.candid, R.redness, R.pct, R.err, R.err_kish,"
+            ,"R.rank, R.bloc, R.bloc_rank,"
+            ,"CASE WHEN R.rank<=R.seats THEN R.pct-L.pct WHEN R.rank>R.seats THEN R.pct-W.pct END AS seat_gap,"
+            ,"CASE WHEN R.rank IS NOT NULL THEN R.pct-100.0/(R.seats+1) END AS threshold_gap"
+        ,"FROM ranked R"
+        ,"LEFT JOIN ranked W ON W.region=R.region AND W.window_end=R.window_end AND W.variant=R.variant AND W.rank=R.seats"
+        ,"LEFT JOIN ranked L ON L.region=R.region AND L.window_end=R.window_end AND L.variant=R.variant AND L.rank=R.seats+1"
     ]
     cur.execute(' '.join(sql))
-    conn.commit()
-    return conn,cur
+    cur.execute("CREATE INDEX IF NOT EXISTS ranking_window ON ranking(region, window_end, variant, pct DESC, "
+                "daterange, num, candid, redness, err, err_kish, rank, bloc, bloc_rank, seat_gap, threshold_gap)")
+    cur.execute("DROP TABLE seats")
 
-def get_trend(cur, region, num, include_8888=False, raw=False):
-    "Read from database the rolling poll trend"
-    sql = "SELECT daterange, candid, redness, valid_adj_pct, valid_adj_err " \
-          "FROM overall WHERE region=? AND num=? ORDER BY daterange"
+def get_trend(cur, region, num, include_8888=False, raw=False, kish=False, days=5):
+    '''Read from database the rolling poll trend; with kish, weighted margins
+    use effective sample size. The 5-day windows are the official series read
+    from the snapshots in overall table. Windows of other than 5 days are
+    computed by get_rolling_trends() with the weights of the master file, and
+    so are not comparable to the official series '''
+    if days != 5:
+        trends = get_rolling_trends(cur, region, days, include_8888, raw, kish, [num])
+        if num not in trends:
+            return None, None, []
+        candid, redness, dates, pct, err = trends[num]
+        return candid, redness, [list(point) for point in zip(dates, pct, err)]
+    sql = "SELECT window_end, candid, redness, valid_adj_pct, valid_adj_err " \
+          "FROM overall WHERE region=? AND num=? ORDER BY window_end"
     if include_8888:
         sql = sql.replace("valid_","")
     if raw:
         sql = sql.replace("adj_","vote_")
+    elif kish:
+        sql = sql.replace("adj_err","adj_err_kish")
     rows = list(cur.execute(sql, (region, num)))
     if not rows:
         return None, None, []
@@ -278,30 +630,124 @@ def get_trend(cur, region, num, include_8888=False, raw=False):
     candid = rows[0][1]
     redness = rows[0][2]
     for row in rows:
-        date = datetime.strptime('2016'+row[0][-4:], "%Y%m%d")
-        ret.append([date, row[3], row[4]])
+        ret.append([datetime.fromisoformat(row[0]), row[3], row[4]])
     return candid, redness, ret
 
-def get_rank(cur, region, date, include_8888=False, raw=False):
-    "Read from database the latest ranking"
+def get_region_trends(cur, region, include_8888=False, raw=False, kish=False, days=5):
+    '''Read from database the rolling poll trends of all candidates of a region
+    in one query. Return dict of num -> (candid, redness, dates, pct, err) in
+    order of num, where dates, pct and err are lists in order of date. As in
+    get_trend(), only 5-day windows are the official series; others are
+    computed by get_rolling_trends() with the weights of the master file '''
+    if days != 5:
+        return get_rolling_trends(cur, region, days, include_8888, raw, kish)
+    sql = "SELECT num, window_end, candid, redness, valid_adj_pct, valid_adj_err " \
+          "FROM overall WHERE region=? AND num>0 AND num<30 ORDER BY num, window_end"
+    if include_8888:
+        sql = sql.replace("valid_","").replace("num>0 AND num<30","(num>0 AND num<30 OR num=8888)")
+    if raw:
+        sql = sql.replace("adj_","vote_")
+    elif kish:
+        sql = sql.replace("adj_err","adj_err_kish")
+    dates = {} # parse each date once
+    ret = {}
+    for num, window_end, candid, redness, pct, err in cur.execute(sql, (region,)):
+        if num not in ret:
+            ret[num] = (candid, redness, [], [], [])
+        if window_end not in dates:
+            dates[window_end] = datetime.fromisoformat(window_end)
+        series = ret[num]
+        series[2].append(dates[window_end])
+        series[3].append(pct)
+        series[4].append(err)
+    return ret
+
+def get_rolling_trends(cur, region, days, include_8888=False, raw=False, kish=False, nums=None):
+    '''Compute from daily table the trends of candidates of a region over
+    windows of days days ending on each date, or all days since the first date
+    if days is 0. Return the same as get_region_trends(), for nums if given
+
+    Counts of each day are accumulated once into prefix sums, so the sum over
+    any window is the difference of two prefix sums. Like overall table, a
+    candidate has no point in a window without its votes. The daily table is
+    made by builddaily(), not buildsqlite() '''
+    if not list(cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily'")):
+        raise ValueError("No daily table in database for %d-day windows, call builddaily() first" % days)
+    first, last = cur.execute("SELECT MIN(date), MAX(date) FROM daily").fetchone()
+    if first is None:
+        return {}
+    start = datetime.fromisoformat(first)
+    ndays = (datetime.fromisoformat(last) - start).days + 1
+    # prefix[num][k][d] is the sum of votes (k=0), adj (k=1) or adj2 (k=2) before day d
+    prefix = {}
+    answered = [[0]*(ndays+1) for _ in range(3)]
+    valid = [[0]*(ndays+1) for _ in range(3)]
+    sql = "SELECT date, num, votes, adj, adj2 FROM daily WHERE region=?"
+    for date, num, *values in cur.execute(sql, (region,)):
+        day = (datetime.fromisoformat(date) - start).days + 1
+        sums = prefix.setdefault(num, [[0]*(ndays+1) for _ in range(3)])
+        for k, value in enumerate(values):
+            sums[k][day] += value
+            answered[k][day] += value
+            if 0 < num < 30:
+                valid[k][day] += value
+    for sums in list(prefix.values()) + [answered, valid]:
+        for series in sums:
+            for day in range(ndays):
+                series[day+1] += series[day]
+    def window(series, end):
+        "Sum of a prefix series over the window ending before day end"
+        return series[end] - series[end-days if days else 0]
+    ends = list(range(days if days else 1, ndays+1))
+    dates = [start + timedelta(days=end-1) for end in ends]
+    total = answered if include_8888 else valid
+    weighted = 0 if raw else 1
+    sizes = [window(total[0 if raw else 1], end) for end in ends]
+    if kish and not raw:
+        sizes = [window(total[1], end)**2/window(total[2], end) if window(total[2], end) else 0 for end in ends]
+    if nums is None:
+        nums = sorted(num for num in prefix if 0 < num < 30 or include_8888 and num == 8888)
+    sql = "SELECT num, redness, who FROM redness WHERE region=?"
+    candids = {num-800 if region == 'SuperDC' else num:(who, red) for num, red, who in cur.execute(sql, (region,))}
+    ret = {}
+    for num in nums:
+        if num not in prefix or not (0 < num < 30 or include_8888 and num == 8888):
+            continue
+        points = [(date, window(prefix[num][weighted], end)*100.0/window(total[weighted], end), size)
+                  for date, end, size in zip(dates, ends, sizes) if window(prefix[num][0], end) > 0]
+        if not points:
+            continue
+        pointdates, pct, n = map(list, zip(*points))
+        candid, redness = candids.get(num, (None, None))
+        ret[num] = (candid, redness, pointdates, pct, error_margins(1.96, n, pct))
+    return ret
+
+def _window_end(date):
+    "Convert a date as accepted by get_rank() into ISO format string"
     if isinstance(date, datetime):
-        datestr = date.strftime("%m%d")
+        datestr = date.strftime("%Y-%m-%d")
+    elif isinstance(date, str) and len(date) == 10:
+        datestr = date # already in ISO format
     elif isinstance(date, str):
-        datestr = date
-        assert(len(datestr)==4)
+        assert(len(date)==4)
+        datestr = "2016-%s-%s" % (date[:2], date[2:])
     elif isinstance(date, int):
-        datestr = "08%02d" % date
+        datestr = "2016-08-%02d" % date
     else:
         raise TypeError("Unknown type %s for %s" % (type(date), date))
-    assert(len(datestr)==4)
-    sql = "SELECT daterange, num, candid, redness, valid_adj_pct, valid_adj_err " \
-          "FROM overall " \
-          "WHERE region=? AND daterange LIKE '%%%s' AND num<30 ORDER BY valid_adj_pct DESC" % datestr
-    if include_8888:
-        sql = sql.replace("valid_","").replace("num<30","(num<30 OR num=8888)")
-    if raw:
-        sql = sql.replace("adj_","vote_")
-    rows = list(cur.execute(sql, (region,)))
+    return datestr
+
+def _variant(include_8888, raw):
+    "Name of the share in ranking table, also the prefix of its columns in overall"
+    return ("" if include_8888 else "valid_") + ("vote" if raw else "adj")
+
+def get_rank(cur, region, date, include_8888=False, raw=False, kish=False):
+    "Read from database the ranking of the window ending on date"
+    sql = "SELECT daterange, num, candid, redness, pct, err FROM ranking " \
+          "WHERE region=? AND window_end=? AND variant=? ORDER BY pct DESC"
+    if kish:
+        sql = sql.replace("err","err_kish")
+    rows = list(cur.execute(sql, (region, _window_end(date), _variant(include_8888, raw))))
     if not rows:
         return None, []
     ret = []
@@ -310,6 +756,160 @@ def get_rank(cur, region, date, include_8888=False, raw=False):
         ret.append(row[1:])
     return daterange, ret
 
+def get_bubble(cur, region, date, include_8888=False, raw=False, kish=False):
+    '''Read from database the candidates whose distance to the seat line is
+    within their error margin, in order of rank: list of (rank, num, candid,
+    redness, pct, err, seat_gap) '''
+    sql = "SELECT rank, num, candid, redness, pct, err, seat_gap FROM ranking " \
+          "WHERE region=? AND window_end=? AND variant=? AND ABS(seat_gap)<=err ORDER BY pct DESC"
+    if kish:
+        sql = sql.replace("err","err_kish")
+    return list(cur.execute(sql, (region, _window_end(date), _variant(include_8888, raw))))
+
+def get_latest_date(cur):
+    "Read from database the first and last date of the latest rolling window"
+    return tuple(list(cur.execute("SELECT window_start, MAX(window_end) FROM overall"))[0])
+
+class QueryCache:
+    '''Memoized get_trend(), get_region_trends(), get_rank(), get_bubble()
+    and get_latest_date() on a database built by buildsqlite()
+
+    Results are kept until the build stamp (user_version) or the manifest of
+    the database changes, which is checked on every call. The results are
+    shared between calls, so do not modify them. hits and misses count the
+    calls answered from memory and from database.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.hits = self.misses = 0
+        self._stamp = None
+        self._results = {}
+
+    def stamp(self):
+        "The build stamp and manifest of database"
+        version, = self.cur.execute("PRAGMA user_version").fetchone()
+        manifest, = self.cur.execute("SELECT group_concat(sourcefile||sha256) FROM "
+                                     "(SELECT * FROM manifest ORDER BY sourcefile)").fetchone()
+        return version, manifest
+
+    def _query(self, func, *args):
+        stamp = self.stamp()
+        if stamp != self._stamp:
+            self._results.clear()
+            self._stamp = stamp
+        key = (func.__name__,) + args
+        if key in self._results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._results[key] = func(self.cur, *args)
+        return self._results[key]
+
+    def get_trend(self, region, num, include_8888=False, raw=False, kish=False, days=5):
+        return self._query(get_trend, region, num, include_8888, raw, kish, days)
+
+    def get_region_trends(self, region, include_8888=False, raw=False, kish=False, days=5):
+        return self._query(get_region_trends, region, include_8888, raw, kish, days)
+
+    def get_rank(self, region, date, include_8888=False, raw=False, kish=False):
+        return self._query(get_rank, region, date, include_8888, raw, kish)
+
+    def get_bubble(self, region, date, include_8888=False, raw=False, kish=False):
+        return self._query(get_bubble, region, date, include_8888, raw, kish)
+
+    def get_latest_date(self):
+        return self._query(get_latest_date)
+
+class PageData(QueryCache):
+    '''All data of a page built by create_charts() and create_tables(), in
+    all four variants of share, read from database at construction
+
+    The trends of all regions come from one query on overall, with the dates
+    parsed once and the date list and candidate metadata of a series shared
+    by all variants; the ranking of the latest window comes from one query on
+    ranking. Other queries are answered as by QueryCache. The preloaded data
+    is not refreshed when the database changes.
+    '''
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.latest = get_latest_date(self.cur)
+        errs = ["vote_err", "valid_vote_err", "adj_err", "valid_adj_err", "adj_err_kish", "valid_adj_err_kish"]
+        sql = "SELECT region, num, window_end, candid, redness, vote_pct, valid_vote_pct, adj_pct, valid_adj_pct, %s " \
+              "FROM overall WHERE num>0 AND num<30 OR num=8888 ORDER BY region, num, window_end" % ",".join(errs)
+        dates = {} # parse each date once
+        self.series = {} # region -> num -> (candid, redness, dates, {column: values})
+        for region, num, window_end, candid, redness, *values in self.cur.execute(sql):
+            trends = self.series.setdefault(region, {})
+            if num not in trends:
+                trends[num] = (candid, redness, [], {c:[] for c in ["vote_pct", "valid_vote_pct", "adj_pct", "valid_adj_pct"]+errs})
+            if window_end not in dates:
+                dates[window_end] = datetime.fromisoformat(window_end)
+            trends[num][2].append(dates[window_end])
+            for column, value in zip(trends[num][3], values):
+                trends[num][3][column].append(value)
+        sql = "SELECT region, variant, daterange, num, candid, redness, pct, err, err_kish FROM ranking " \
+              "WHERE window_end=? ORDER BY region, variant, pct DESC"
+        self.ranks = {}
+        for region, variant, daterange, *row in self.cur.execute(sql, (self.latest[1],)):
+            self.ranks.setdefault((region, variant), (daterange, []))[1].append(row)
+
+    def get_region_trends(self, region, include_8888=False, raw=False, kish=False, days=5):
+        if days != 5:
+            return super().get_region_trends(region, include_8888, raw, kish, days)
+        pct, err = self._columns(include_8888, raw, kish)
+        return {num:(candid, redness, dates, values[pct], values[err])
+                for num, (candid, redness, dates, values) in self.series.get(region, {}).items()
+                if 0 < num < 30 or include_8888 and num == 8888}
+
+    def get_trend(self, region, num, include_8888=False, raw=False, kish=False, days=5):
+        if days != 5 or num not in self.series.get(region, {}):
+            return super().get_trend(region, num, include_8888, raw, kish, days)
+        candid, redness, dates, values = self.series[region][num]
+        pct, err = self._columns(include_8888, raw, kish)
+        return candid, redness, [list(point) for point in zip(dates, values[pct], values[err])]
+
+    @staticmethod
+    def _columns(include_8888, raw, kish):
+        "Names of the pct and err columns of overall in a variant"
+        variant = _variant(include_8888, raw)
+        return variant+"_pct", variant+"_err"+("_kish" if kish and not raw else "")
+
+    def get_rank(self, region, date, include_8888=False, raw=False, kish=False):
+        if _window_end(date) != self.latest[1]:
+            return super().get_rank(region, date, include_8888, raw, kish)
+        daterange, rows = self.ranks.get((region, _variant(include_8888, raw)), (None, []))
+        return daterange, [row[:4] + [row[5] if kish else row[4]] for row in rows]
+
+    def get_latest_date(self):
+        return self.latest
+
+def _query_cache(cur):
+    "Return cur if it is a QueryCache, otherwise a new QueryCache on its connection"
+    return cur if isinstance(cur, QueryCache) else QueryCache(cur.connection)
+
+_code_stamp = None
+
+def region_fingerprint(cur, region, include_8888=False, raw=False, kish=False, salt=b''):
+    '''SHA-256 hex digest of all a region shows in a variant of create_charts()
+    and create_tables(): its trends, the ranking of the latest window, and
+    this module and Bokeh version which render them; cur may be a QueryCache.
+    salt is bytes of any other code or data rendering the region'''
+    global _code_stamp
+    if _code_stamp is None:
+        import bokeh
+        with open(__file__, 'rb') as fp:
+            _code_stamp = hashlib.sha256(fp.read() + bokeh.__version__.encode('utf-8')).digest()
+    queries = _query_cache(cur)
+    latest = queries.get_latest_date()
+    data = [region, include_8888, raw, kish, latest,
+            sorted(queries.get_region_trends(region, include_8888, raw, kish).items()),
+            queries.get_trend(region, 8888, True, kish=kish) if include_8888 and raw else None,
+            queries.get_rank(region, latest[1], include_8888, raw, kish)]
+    digest = hashlib.sha256(_code_stamp + salt)
+    digest.update(repr(data).encode('utf-8'))
+    return digest.hexdigest()
+
 # colours
 bluecode = brewer['Blues'][9]
 redcode = brewer["PuRd"][9]
@@ -337,102 +937,114 @@ regions = [["香港島","HKIsland",6],
            ["新界西","NTWest",9],["新界東","NTEast",9],
            ["超區","SuperDC",5]]
 
-def create_charts(cur, include_8888=False, raw=False):
-    " Create chart on each tab for 5 regions + super DC "
-    tables = create_tables(cur, for_div=True, include_8888=include_8888, raw=raw)
+def create_charts(cur, include_8888=False, raw=False, kish=False, codes=None, cache=None):
+    ''' Create chart on each tab for 5 regions + super DC, or only the regions
+        in codes; cur may be a QueryCache, and ranking tables are reused from
+        cache as in create_tables() '''
+    queries = _query_cache(cur)
+    tables = create_tables(queries, for_div=True, include_8888=include_8888, raw=raw, kish=kish, cache=cache)
     tabs = []
     for title,code,seats in regions:
+        if codes is not None and code not in codes: continue
         # chart components
         p = figure(x_axis_label='滾動日期', y_axis_label='支持%' if include_8888 else '有效支持%', x_axis_type="datetime")
-        candids = []
         # line, label, error of each candidate
-        earliest_date, latest_date = None, None
-        for n in range(1,30):
-            candid, redness, trend = get_trend(cur, code, n, include_8888, raw=raw)
-            if not trend: continue
-            earliest_date = min(earliest_date, trend[0][0]) if earliest_date else trend[0][0]
-            latest_date   = max(latest_date, trend[-1][0]) if latest_date else trend[-1][0]
-            colour = getcolour(redness)
-
-            label = p.text([trend[-1][0]], [trend[-1][1]], text=[candid.rsplit(None,1)[-1]],
-                           text_align='right', text_alpha=0.9, text_baseline='bottom', text_color=colour,
-                           text_font_size="9pt", y_offset=0.25)
-            line = p.line([d for d,_,_ in trend], [p for _,p,_ in trend], color=colour, line_width=2, line_alpha=0.9)
-            circle = p.circle([d for d,_,_ in trend], [p for _,p,_ in trend], color=colour, size=4, line_alpha=0.9)
-            margin = p.multi_line([(d,d) for d,_,_ in trend], [(p-e,p+e) for _,p,e in trend], color=colour, line_width=1, line_alpha=0.9)
-            candids.append([n, candid, colour, trend[-1][1], line, label, circle, margin])
-        # line, label, error of undecided
+        trends = dict(queries.get_region_trends(code, include_8888, raw, kish))
+        if include_8888 and raw:
+            trends.pop(8888, None) # undecided is always weighted
+            candid, redness, trend = queries.get_trend(code, 8888, True, kish=kish)
+            if trend:
+                trends[8888] = (candid, redness, [d for d,_,_ in trend], [p for _,p,_ in trend], [e for _,_,e in trend])
+        if not trends or include_8888 and 8888 not in trends: continue
+        earliest_date = min(dates[0] for _,_,dates,_,_ in trends.values())
+        latest_date   = max(dates[-1] for _,_,dates,_,_ in trends.values())
+        candids = []
+        for n, (candid, redness, dates, pcts, errs) in trends.items():
+            if n == 8888:
+                candid, colour = "未決定", '#707070'
+                text = candid
+            else:
+                colour = getcolour(redness)
+                text = candid.rsplit(None,1)[-1]
+            candids.append([n, candid, colour, pcts[-1], text, dates, pcts, errs])
+        top_n = [n for _,n in sorted([(c[3],n) for n,c in enumerate(candids) if c[0]<30], reverse=True)][:seats]
         if include_8888:
-            candid, redness, trend = get_trend(cur, code, 8888, True)
-            if not trend: continue
-            earliest_date = min(earliest_date, trend[0][0]) if earliest_date else trend[0][0]
-            latest_date   = max(latest_date, trend[-1][0]) if latest_date else trend[-1][0]
-            colour = '#707070'
-            label = p.text([trend[-1][0]], [trend[-1][1]], text=["未決定"],
-                           text_align='right', text_alpha=0.9, text_baseline='bottom', text_color=colour,
-                           text_font_size="9pt", y_offset=0.25)
-            line = p.line([d for d,_,_ in trend], [p for _,p,_ in trend], color=colour, line_width=2, line_alpha=0.9)
-            circle = p.circle([d for d,_,_ in trend], [p for _,p,_ in trend], color=colour, size=4, line_alpha=0.9)
-            margin = p.multi_line([(d,d) for d,_,_ in trend], [(p-e,p+e) for _,p,e in trend], color=colour, line_width=1, line_alpha=0.9)
-            candids.append([8888, "未決定", "#707070", trend[-1][1], line, label, circle, margin])
+            top_n.append(len(candids)-1) # last index = 8888
+        # all candidates share one source of one row per point, and the rows
+        # of candidate n are starts[n] to starts[n+1]; a line is drawn as
+        # segments to the next point and hidden by zero alpha. Percentages
+        # are rounded to 0.001 to keep the page small
+        data = dict(x=[], y=[], x_next=[], y_next=[], lower=[], upper=[], colour=[], label=[], line_alpha=[], point_alpha=[])
+        starts = [0]
+        for n, (_, _, colour, _, text, dates, pcts, errs) in enumerate(candids):
+            ys = [round(p,3) for p in pcts]
+            data['x'] += dates
+            data['y'] += ys
+            data['x_next'] += dates[1:] + dates[-1:]
+            data['y_next'] += ys[1:] + ys[-1:]
+            data['lower'] += [round(p-e,3) for p,e in zip(pcts,errs)]
+            data['upper'] += [round(p+e,3) for p,e in zip(pcts,errs)]
+            data['colour'] += [colour] * len(dates)
+            data['label'] += [''] * (len(dates)-1) + [text]
+            data['line_alpha'] += [0.9 if n in top_n else 0.0] * len(dates)
+            data['point_alpha'] += [0.0] * len(dates)
+            starts.append(starts[-1] + len(dates))
+        source = ColumnDataSource(data=data)
+        p.segment('x', 'y', 'x_next', 'y_next', source=source, line_color='colour', line_alpha='line_alpha',
+                  line_width=2, line_cap='round')
+        p.text('x', 'y', text='label', source=source,
+               text_align='right', text_alpha='line_alpha', text_baseline='bottom', text_color='colour',
+               text_font_size="9pt", y_offset=0.25)
+        p.circle('x', 'y', source=source, color='colour', size=4, line_alpha='point_alpha', fill_alpha='point_alpha')
+        p.segment('x', 'lower', 'x', 'upper', source=source, line_color='colour', line_alpha='point_alpha', line_width=1)
         p.line([earliest_date, latest_date],[100.0/(seats+1), 100.0/(seats+1)],
                line_dash=[6,3], color="black", line_width=2, line_alpha=0.5)
         p.text([earliest_date], [100.0/(seats+1)], text=["穩勝門檻"],
                text_align='left', text_alpha=0.9, text_baseline='bottom', text_color="black",
                        text_font_size="8pt", y_offset=0.15)
         # control
-        all_lines = [n for n,_ in enumerate(candids)]
-        top_n = [n for _,n in sorted([(c[3],n) for n,c in enumerate(candids) if c[0]<30], reverse=True)][:seats]
-        if include_8888:
-            top_n.append(len(candids)-1) # last index = 8888
-        for n in all_lines:
-            candids[n][-1].visible = \
-            candids[n][-2].visible = False
-            if n not in top_n:
-                candids[n][-3].visible = \
-                candids[n][-4].visible = False
-
-        customjs_params = [("line%d"%n, candid[-4]) for n,candid in enumerate(candids)] + \
-                          [("label%d"%n, candid[-3]) for n,candid in enumerate(candids)] + \
-                          [("circle%d"%n, candid[-2]) for n,candid in enumerate(candids)] + \
-                          [("margin%d"%n, candid[-1]) for n,candid in enumerate(candids)]
         jscode = '''
-            var lines = [%s];
-            var labels = [%s];
-            var circles = [%s];
-            var margins = [%s];
-            for (var n=0; n<lines.length; n++) {
-                lines[n].visible  = (cb_obj.active.indexOf(n+1) >= 0);
-                labels[n].visible = (cb_obj.active.indexOf(n+1) >= 0);
-                circles[n].visible = (cb_obj.active.indexOf(0) >= 0 && cb_obj.active.indexOf(n+1) >= 0);
-                margins[n].visible = (cb_obj.active.indexOf(0) >= 0 && cb_obj.active.indexOf(n+1) >= 0);
-            };''' % (",".join("line%d" % n for n in all_lines),
-                     ",".join("label%d" % n for n in all_lines),
-                     ",".join("circle%d" % n for n in all_lines),
-                     ",".join("margin%d" % n for n in all_lines))
+            var data = source.data;
+            var starts = [%s];
+            var errors = (cb_obj.active.indexOf(0) >= 0);
+            for (var n=0; n+1<starts.length; n++) {
+                var shown = (cb_obj.active.indexOf(n+1) >= 0);
+                for (var i=starts[n]; i<starts[n+1]; i++) {
+                    data['line_alpha'][i] = shown ? 0.9 : 0.0;
+                    data['point_alpha'][i] = (shown && errors) ? 0.9 : 0.0;
+                };
+            };
+            source.change.emit();''' % ",".join(str(n) for n in starts)
         cblabels = ['誤差@95%CI'] + \
                    [str(800+c[0] if code=='SuperDC' else c[0])+' '+c[1]+' '+("%.2f%%"%c[3]) for c in candids]
         checkbox = CheckboxGroup(labels=cblabels, active=[n+1 for n in top_n])
-        checkbox.callback = CustomJS(args=dict(customjs_params), code=jscode)
+        checkbox.callback = CustomJS(args=dict(source=source), code=jscode)
         # ranking table
         div = Div(text=tables[code], width=600)
         # layout and show
         layout = row(checkbox, p, div)
-        tab = Panel(child=layout, title=title+"民調（"+str(seats)+'席）')
+        tab = Panel(child=layout, title=title+"民調（"+str(seats)+'席）', name=code)
         tabs.append(tab)
     # build and return
     return Tabs(tabs=tabs)
 
-def create_tables(cur, for_div=False, include_8888=False, raw=False):
-    " Produce ranking table "
+def create_tables(cur, for_div=False, include_8888=False, raw=False, kish=False, cache=None):
+    ''' Produce ranking table; cur may be a QueryCache. With for_div and a
+        FragmentCache, the HTML of a region is reused while its
+        region_fingerprint() is unchanged '''
+    queries = _query_cache(cur)
     tabs = {}
-    lastdate = list(cur.execute("SELECT MAX(daterange) FROM overall"))[0][0]
-    rangetext = lastdate[6:8]+'/'+lastdate[4:6]+'至'+lastdate[11:13]+'/'+lastdate[9:11]
+    firstdate, lastdate = queries.get_latest_date()
+    rangetext = firstdate[8:10]+'/'+firstdate[5:7]+'至'+lastdate[8:10]+'/'+lastdate[5:7]
     for title,code,_ in regions:
-        daterange, rankdata = get_rank(cur, code, lastdate[-4:], include_8888, raw)
+        if for_div and cache is not None:
+            key = "table.%s.%s%s" % (code, _variant(include_8888, raw), ".kish" if kish else "")
+            fingerprint = region_fingerprint(queries, code, include_8888, raw, kish)
+            tabs[code] = cache.get(key, fingerprint)
+            if tabs[code] is not None: continue
+        daterange, rankdata = queries.get_rank(code, lastdate, include_8888, raw, kish)
         if code == 'SuperDC':
-            for n,row in enumerate(rankdata):
-                rankdata[n] = [800+row[0]]+list(row[1:])
+            rankdata = [[800+row[0]]+list(row[1:]) for row in rankdata]
         tabletitle = rangetext+title+'民調排名'
         human, beast = [r for r in rankdata if r[2] is not None and r[2]<0], [r for r in rankdata if r[2] is not None and r[2]>0]
         header = ["編號","政黨","候選人","%" if include_8888 else "有效%",""]
@@ -470,4 +1082,6 @@ def create_tables(cur, for_div=False, include_8888=False, raw=False):
             display(HTML(table._repr_html_()))
         else:
             tabs[code] = table._repr_html_()
+            if cache is not None:
+                cache.put(key, fingerprint, tabs[code])
     if tabs: return tabs
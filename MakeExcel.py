@@ -8,37 +8,38 @@
 import sys
 assert(sys.version_info.major == 3) # Python3 only!
 
-import urllib.request
 import urllib.parse
 import os.path
-import csv
-import itertools
+import io
 import datetime
 import math
 
 import lxml.html
-import yaml
 import xlsxwriter
 
 import arial10
+from csvyreader import parse_all, parse_fields, pydate
+from downloader import Fetcher
 
 def webscraping():
     'A generator to fetch all CSVY files of 2016 LegCo rolling data from HKU POP'
     # XPath 2.0 is not supported, so use substring() instead of ends-with()
     main_url = 'http://data.hkupop.hku.hk/v2/hkupop/lc_election/ch.html'
     xpath = "//a[text()='下載']/@href[substring(.,string-length(.)-string-length('.csvy')+1)='.csvy']"
-    text = urllib.request.urlopen(main_url).read().decode('utf-8')
+    fetcher = Fetcher()
+    text = fetcher.fetch(main_url)
     dom = lxml.html.document_fromstring(text)
     csvyurls = [urllib.parse.urljoin(main_url,relurl) for relurl in dom.xpath(xpath)]
-    for url in reversed(csvyurls):
-        yield url, urllib.request.urlopen(url).read().decode('utf-8')
+    for url, text in fetcher.fetch_all(reversed(csvyurls)):
+        yield url, io.StringIO(text, newline='')
 
 def localscraping():
     'Simulate webscraping() by using local dir'
     import os
     files = [f for f in os.listdir() if f.endswith('.csvy')]
     for f in files:
-        yield f, open(f,encoding='utf-8').read()
+        with open(f,encoding='utf-8',newline='') as fileobj:
+            yield f, fileobj
 
 def deduce_name(url):
     "Deduce worksheet name from URL"
@@ -80,7 +81,7 @@ def breaklabel(label):
     else:
         return label.replace(']',']\n',1)
 
-def buildexcel(file_dest):
+def buildexcel(file_dest, jobs=1, cachedir=None):
     # prepare an empty workbook
     workbook = xlsxwriter.Workbook(file_dest, {'default_date_format':'YYYY-mm-dd'})
     header_row_format = workbook.add_format({'bg_color':'#C2C2D6',
@@ -89,20 +90,9 @@ def buildexcel(file_dest):
                                              'font_name':'Arial', 'font_size':10})
     data_row_format = workbook.add_format({'font_name':'Arial', 'font_size':10})
     # work on each URL, as one new worksheet
-    for url, csvy in webscraping():
+    for url, fields_def_yaml, header, batches in parse_all(webscraping(), pydate, jobs, cachedir=cachedir):
         print(url)
-        lines = csvy.split("\n")
-        # Extract and parse the CSVY metadata part
-        fields_def_yaml = [ln[1:] for ln in itertools.takewhile(lambda s:s[0]=='#', lines)]
-        if not fields_def_yaml:
-            # the metadata is not in comment, look for limiters instead
-            fields_def_yaml = [ln for ln in itertools.takewhile(lambda s:not s.startswith('---'), lines[1:])]
-        else:
-            fields_def_yaml = fields_def_yaml[1:-1]
-        fields_def = yaml.load("\n".join(fields_def_yaml))
-        assert('fields' in fields_def)
-        assert(all('name' in f for f in fields_def['fields']))
-        fields = {f['name']:f for f in fields_def['fields']}
+        fields = {f['name']:f for f in parse_fields(fields_def_yaml)}
         for name in fields:
             if 'labels' in fields[name]:
                 labeltext = "\n".join(
@@ -110,47 +100,34 @@ def buildexcel(file_dest):
                      for x1,x2 in sorted(fields[name]['labels'].items(), key=lambda x:x[1])]
                 )
                 fields[name]['labels'] = labeltext
-        # Extract and parse the CSVY data part
-        csvdata = list(csv.reader([ln+'\n' for ln in lines[len(fields_def_yaml)+2:]]))
         # Create worksheet and set title
         worksheet = workbook.add_worksheet(deduce_name(url)) # new sheet at end
         # Header rows: label, labels, name
-        header = csvdata[0]
-        if len(header) < len(csvdata[1]):
-            # in case header row is shorter, align to right
-            header = [None] * (len(csvdata[1]) - len(header)) + header
         option = [fields.get(h,{}).get('labels',' ') for h in header]
         label = [breaklabel(fields.get(h,{}).get('label',' ')) for h in header]
         worksheet.write_row(0, 0, header, header_row_format)
         worksheet.write_row(1, 0, option, header_row_format)
         worksheet.write_row(2, 0, label, header_row_format)
+        # Column width: usually to fit the option text, widen as data rows are written
+        colwidths = [max(arial10.fitwidth(x) for x in ["00000",header[c],option[c]] if x)
+                     for c in range(len(header))]
         # Data rows
-        for j, row in enumerate(csvdata[1:]):
-            for i, col in enumerate(row):
-                if header[i] == 'date':
-                    row[i] = datetime.datetime.strptime(col, "%Y%m%d").date()
-                elif col.isdigit():
-                    row[i] = int(col)
-                else:
-                    try:
-                        row[i] = float(col)
-                    except:
-                        row[i] = None if col == 'NA' else col
-            worksheet.write_row(3+j, 0, row, data_row_format)
+        j = 0
+        rows = (row for batch in batches for row in batch)
+        for j, row in enumerate(rows, 1):
+            for i, value in enumerate(row):
+                colwidths[i] = max(colwidths[i], arial10.fitwidth(str(value)))
+            worksheet.write_row(2+j, 0, row, data_row_format)
         # Add autofilter
         ignore_col = ['weight','caseid',None]
-        maxrow = len(csvdata)+2
+        maxrow = j+2
         minrow = 2
         mincol = min(i for i,c in enumerate(header) if c not in ignore_col)
         maxcol = max(i for i,c in enumerate(header) if c not in ignore_col)
         worksheet.autofilter(minrow, mincol, maxrow, maxcol)
-        # Adjust column width: usually to fit the option text
-        colwidths = []
-        for c in range(len(header)):
-            columndata = ["00000",header[c],option[c]]+[str(row[c]) for row in csvdata[1:] if len(row)>c]
-            width = max(arial10.fitwidth(x) for x in columndata if x)
+        # Adjust column width
+        for c, width in enumerate(colwidths):
             worksheet.set_column(c, c, width/256.0)
-            colwidths.append(width)
         # Adjust row height for option text row
         height = max(arial10.fitheight(x) for x in option if x)
         worksheet.set_row(1, height/18.0)
@@ -198,5 +175,7 @@ if __name__ == '__main__':
             """)
     )
     parser.add_argument("filename", nargs='?', default="RollingPoll.xlsx", help="Output Excel filename")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes to parse files")
+    parser.add_argument("-c", "--cachedir", help="Directory to keep parsed files in binary columnar format")
     args = parser.parse_args()
-    buildexcel(args.filename)
+    buildexcel(args.filename, args.jobs, args.cachedir)
@@ -1,19 +1,87 @@
 # -*- coding: utf-8 -*-
 
 from FrontlineTechWorkerRollingHelper import *
+from assets import FragmentCache, write_file
 
-conn, cur = buildsqlite("poll.db", True)
-tabpanel1 = create_charts(cur, False)
-tabpanel2 = create_charts(cur, True)
-tabpanel = Tabs(tabs=[Panel(child=tabpanel1, title="不包游離票"),Panel(child=tabpanel2, title="包括游離票")])
+import hashlib, json, os, sys, time
+start = time.perf_counter()
+conn, cur = buildsqlite("poll.db", True, incremental=True, cachedir=".csvycache")
+built = time.perf_counter()
+data = PageData(conn) # all four variants of every series, read once
+loaded = time.perf_counter()
 
 from bokeh.embed import notebook_div, file_html
 from bokeh.resources import CDN
-html = file_html(tabpanel,CDN)
-open("chart.html","w").write(html)
 
-tabpanel1 = create_charts(cur, False, True)
-tabpanel2 = create_charts(cur, True, True)
-tabpanel = Tabs(tabs=[Panel(child=tabpanel1, title="不包游離票"),Panel(child=tabpanel2, title="包括游離票")])
-html = file_html(tabpanel,CDN)
-open("chart.raw.html","w").write(html)
+# Pages, ranking tables and split charts are kept in .chartcache under the
+# fingerprints of the regions they show, so only what has changed since last
+# run is rendered again, and files of the same content are not rewritten
+cache = FragmentCache(".chartcache")
+salt = open(__file__, 'rb').read()
+
+# With --split DIR, also write small pages to DIR loading BokehJS from
+# content-hashed files and the charts of each region from a JSON file when its
+# tab is shown, all with precompressed copies
+split = "--split" in sys.argv
+if split:
+    from bokeh.document import Document
+    from bokeh.resources import INLINE
+    from assets import write_hashed, tab_html, lazy_div, shell_html
+    outdir = sys.argv[sys.argv.index("--split")+1]
+    os.makedirs(outdir, exist_ok=True)
+    scripts = [write_hashed(outdir, "bokeh.js", "\n".join(INLINE.js_raw))]
+    styles = [write_hashed(outdir, "bokeh.css", "\n".join(INLINE.css_raw))]
+    render = '''
+function renderChart(div, item) {
+  var plot = document.createElement('div');
+  plot.className = 'bk-plotdiv';
+  plot.id = item.render_items[0].elementid;
+  div.classList.add('bk-root');
+  div.appendChild(plot);
+  Bokeh.embed.embed_items(item.docs_json, item.render_items);
+}'''
+
+def write_split(filename, raw, fingerprints, tabpanels=None):
+    '''Write the charts of each region as JSON and a page loading them. The
+    JSON of a region is reused from cache if its fingerprint is unchanged,
+    otherwise made from its tab in tabpanels, or created if not there'''
+    variants = []
+    for n, (variant, include_8888) in enumerate([("", False), (".8888", True)]):
+        tabs = {tab.name:tab for tab in tabpanels[n].tabs} if tabpanels else {}
+        panels = []
+        for title, code, seats in regions:
+            stem = filename[:-5] + variant + "." + code
+            itemjson = cache.get(stem, fingerprints[include_8888, code])
+            if itemjson is None:
+                if code not in tabs:
+                    tabs.update((tab.name, tab) for tab in create_charts(data, include_8888, raw, codes=[code], cache=cache).tabs)
+                if code not in tabs: continue # no data of region
+                # each region as a document of its own, as file_html() would embed it
+                doc = Document()
+                doc.add_root(tabs[code].child)
+                item = dict(title=tabs[code].title, docs_json={stem:doc.to_json()},
+                            render_items=[dict(docid=stem, elementid=stem, modelid=tabs[code].child._id)])
+                itemjson = cache.put(stem, fingerprints[include_8888, code], json.dumps(item, separators=(',',':')))
+            write_file(os.path.join(outdir, stem+".json"), itemjson)
+            panels.append((json.loads(itemjson)["title"], lazy_div(stem+".json")))
+        variants.append((["不包游離票","包括游離票"][n], tab_html(panels, "tab%d_" % (n+1))))
+    write_file(os.path.join(outdir, filename), shell_html(tab_html(variants), len(regions), scripts, styles, render))
+
+for filename, raw in [("chart.html", False), ("chart.raw.html", True)]:
+    fingerprints = {(include_8888, code):region_fingerprint(data, code, include_8888, raw, salt=salt)
+                    for include_8888 in [False, True] for _,code,_ in regions}
+    pagefingerprint = hashlib.sha256(repr(sorted(fingerprints.items())).encode('utf-8')).hexdigest()
+    html = cache.get(filename, pagefingerprint)
+    tabpanels = None
+    if html is None:
+        tabpanel1 = create_charts(data, False, raw, cache=cache)
+        tabpanel2 = create_charts(data, True, raw, cache=cache)
+        tabpanels = [tabpanel1, tabpanel2]
+        tabpanel = Tabs(tabs=[Panel(child=tabpanel1, title="不包游離票"),Panel(child=tabpanel2, title="包括游離票")])
+        html = cache.put(filename, pagefingerprint, file_html(tabpanel,CDN))
+    write_file(filename, html, precompress=False)
+    if split:
+        write_split(filename, raw, fingerprints, tabpanels)
+done = time.perf_counter()
+print("database %.2fs, load data %.2fs, charts %.2fs, total %.2fs" % (built-start, loaded-built, done-loaded, done-start))
+print("%d fragments reused, %d rendered" % (cache.hits, cache.misses))
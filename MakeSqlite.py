@@ -8,28 +8,28 @@
 import sys
 assert(sys.version_info.major == 3) # Python3 only!
 
-import urllib.request
 import urllib.parse
 import os.path
-import csv
-import itertools
-import datetime
+import io
 
 import lxml.html
-import yaml
 import sqlite3
 
+from csvyreader import isodate, parse_all, parse_fields
+from downloader import Fetcher
+
 def webscraping():
     'A generator to fetch all CSVY files of 2016 LegCo rolling data from HKU POP'
     # XPath 2.0 is not supported, so use substring() instead of ends-with()
     main_url = 'http://data.hkupop.hku.hk/v2/hkupop/lc_election/ch.html'
     xpath = "//a[text()='下載']/@href[substring(.,string-length(.)-string-length('.csvy')+1)='.csvy']"
-    text = urllib.request.urlopen(main_url).read().decode('utf-8')
+    fetcher = Fetcher()
+    text = fetcher.fetch(main_url)
     dom = lxml.html.document_fromstring(text)
     csvyurls = [urllib.parse.urljoin(main_url,relurl) for relurl in dom.xpath(xpath)]
-    for url in reversed(csvyurls):
-        if 'lc2016_rolling' not in url: continue # prevent mistake
-        yield url, urllib.request.urlopen(url).read().decode('utf-8')
+    csvyurls = [url for url in reversed(csvyurls) if 'lc2016_rolling' in url] # prevent mistake
+    for url, text in fetcher.fetch_all(csvyurls):
+        yield url, io.StringIO(text, newline='')
 
 def localscraping():
     'Simulate webscraping() by using local dir'
@@ -37,7 +37,8 @@ def localscraping():
     files = [f for f in os.listdir() if f.endswith('.csvy')]
     for f in files:
         if 'LC2016_final_' not in f: continue # prevent mistake
-        yield f, open(f,encoding='utf-8').read()
+        with open(f,encoding='utf-8',newline='') as fileobj:
+            yield f, fileobj
 
 def deduce_name(url):
     "Deduce worksheet name from URL"
@@ -144,93 +145,91 @@ def redness(cur):
     cur.execute("CREATE TABLE redness(region,num,redness,who)")
     cur.executemany("INSERT INTO redness(region,num,redness,who) VALUES(?,?,?,?)", data)
 
-def buildsqlite(file_dest):
-    columns = ['sourcefile']
-    data = []
-    answer = []
-    # work on each URL, gather all data
-    for url, csvy in localscraping():
-        print(url)
-        data_name = deduce_name(url)
-        lines = csvy.split("\n")
-        # Extract and parse the CSVY metadata part
-        fields_def_yaml = [ln[1:] for ln in itertools.takewhile(lambda s:s[0]=='#', lines)]
-        if not fields_def_yaml:
-            # the metadata is not in comment, look for limiters instead
-            fields_def_yaml = [ln for ln in itertools.takewhile(lambda s:not s.startswith('---'), lines[1:])]
-        else:
-            fields_def_yaml = fields_def_yaml[1:-1]
-        if not answer: # assume all are the same, so parse only the first one
-            fields_def = yaml.load("\n".join(fields_def_yaml))
-            assert('fields' in fields_def)
-            assert(all('name' in f for f in fields_def['fields']))
-            for f in fields_def['fields']:
-                if 'labels' not in f: continue
-                for answertext, code in f['labels'].items():
-                    answer.append([f['name'], int(code), answertext])
-        # Extract and parse the CSVY data part
-        csvdata = list(csv.reader([ln+'\n' for ln in lines[len(fields_def_yaml)+2:]]))
-        # parse header, and gather data
-        header = csvdata[0]
-        if len(header) < len(csvdata[1]):
-            # in case header row is shorter, align to right
-            header = ['_'+str(int(n+1)) for n in range(len(csvdata[1])-len(header))] + header
-        data += [
-            dict(zip(header, row), sourcefile=data_name) for row in csvdata[1:] if row
-        ]
-        # remember all column names
-        for h in header:
-            if h not in columns:
-                columns.append(h)
-    # Review data, make sure all keys exist
-    for row in data:
-        for h in columns:
-            if h not in row or not row[h] or row[h] == 'NA':
-                row[h] = None
-            elif h == 'date':
-                row[h] = datetime.datetime.strptime(row[h], "%Y%m%d").strftime("%Y-%m-%d")
-            elif row[h].isdigit():
-                row[h] = int(row[h])
-            else:
-                try:
-                    row[h] = float(row[h])
-                except:
-                    pass
-    # Write to SQLite
+def buildsqlite(file_dest, jobs=1, cachedir=None, bulk=False):
+    # Write to SQLite while the data is read
     try:
         os.unlink(file_dest)
     except:
         pass
     conn = sqlite3.connect(file_dest)
     cur = conn.cursor()
+    if bulk:
+        # relax durability while loading, restored after commit
+        pragmas = [(name, cur.execute("PRAGMA %s" % name).fetchone()[0]) for name in ("journal_mode", "synchronous")]
+        cur.execute("PRAGMA journal_mode=MEMORY")
+        cur.execute("PRAGMA synchronous=OFF")
+        cur.execute("BEGIN")
     cur.execute("CREATE TABLE answers(region,value,answer)")
-    cur.executemany("INSERT INTO answers(region,value,answer) VALUES(?,?,?)", answer)
-    columnlist = ",".join(columns)
-    paramlist = ",".join(':'+c for c in columns)
     redness(cur)
-    cur.execute("CREATE TABLE poll(%s)" % columnlist)
-    cur.executemany("INSERT INTO poll(%s) VALUES(%s)" % (columnlist, paramlist), data)
+    cur.execute("CREATE TABLE poll(sourcefile)")
+    columns = ['sourcefile']
+    answered = False
+    # work on each URL, stream all data into poll table
+    for url, fields_def_yaml, header, batches in parse_all(localscraping(), isodate, jobs, cachedir=cachedir):
+        print(url)
+        data_name = deduce_name(url)
+        if not answered: # assume all are the same, so parse only the first one
+            answer = [[f['name'], int(code), answertext]
+                      for f in parse_fields(fields_def_yaml) if 'labels' in f
+                      for answertext, code in f['labels'].items()]
+            cur.executemany("INSERT INTO answers(region,value,answer) VALUES(?,?,?)", answer)
+            answered = True
+        # name the padding columns of a short header
+        header = ['_'+str(n+1) if h is None else h for n,h in enumerate(header)]
+        # remember all column names
+        for h in header:
+            if h not in columns:
+                columns.append(h)
+                cur.execute("ALTER TABLE poll ADD COLUMN %s" % h)
+        columnlist = ",".join(['sourcefile'] + header)
+        paramlist = ",".join(['?'] * (len(header)+1))
+        cur.executemany("INSERT INTO poll(%s) VALUES(%s)" % (columnlist, paramlist),
+                        ((data_name,)+row for batch in batches for row in batch))
+    if bulk:
+        # index after loading
+        cur.execute("CREATE INDEX poll_sourcefile ON poll(sourcefile)")
+        cur.execute("ANALYZE")
+    # denominators of all regions are counted in one pass over poll, then
+    # joined to each region
+    regions = [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]
+    sql = ["CREATE TEMP TABLE denominators AS SELECT sourcefile"]
+    for region,col in regions:
+        sql += [
+                 ",COUNT(%s) AS %s_all" % (col,col)
+                ,",SUM(CASE WHEN %s IS NOT NULL THEN weight END) AS %s_adj" % (col,col)
+                ,",SUM(CASE WHEN %s>0 AND %s<30 THEN weight END) AS %s_valid_adj" % (col,col,col)
+        ]
+    sql += ["FROM poll GROUP BY sourcefile"]
+    cur.execute(' '.join(sql))
+    cur.execute("CREATE UNIQUE INDEX temp.denominators_sourcefile ON denominators(sourcefile)")
     sql = ['CREATE TABLE overall AS']
-    for region,col in [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]:
+    for region,col in regions:
         sql += [
             "SELECT"
                 ,"'%s' AS region," % region
                 ,"SUBSTR(X.sourcefile,14,13) AS daterange,"
+                ,"SUBSTR(X.sourcefile,14,4)||'-'||SUBSTR(X.sourcefile,18,2)||'-'||SUBSTR(X.sourcefile,20,2) AS window_start,"
+                ,"SUBSTR(X.sourcefile,14,4)||'-'||SUBSTR(X.sourcefile,23,2)||'-'||SUBSTR(X.sourcefile,25,2) AS window_end,"
                 ,"COUNT(*) AS votes,"
-                ,"COUNT(*)*100.0/(SELECT COUNT(*) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS vote_pct,"
-                ,"SUM(X.weight)*100.0/(SELECT SUM(weight) FROM poll WHERE",col,"IS NOT NULL AND sourcefile=X.sourcefile) AS adj_pct,"
-                ,"SUM(X.weight)*100.0/(SELECT SUM(weight) FROM poll WHERE",col,">0 AND",col,"<30 AND sourcefile=X.sourcefile) AS valid_pct,"
+                ,"COUNT(*)*100.0/D.%s_all AS vote_pct," % col
+                ,"SUM(X.weight)*100.0/D.%s_adj AS adj_pct," % col
+                ,"SUM(X.weight)*100.0/D.%s_valid_adj AS valid_pct," % col
                 ,col, "AS num,"
                 ,"Y.redness AS redness,"
                 ,"Y.who AS candid"
-            ,("FROM poll X LEFT JOIN redness Y ON Y.region='%s' AND Y.num=X.%s" if region!='SuperDC' else
-              "FROM poll X LEFT JOIN redness Y ON Y.region='%s' AND Y.num=800+X.%s"
+            ,"FROM poll X JOIN denominators D ON D.sourcefile=X.sourcefile"
+            ,("LEFT JOIN redness Y ON Y.region='%s' AND Y.num=X.%s" if region!='SuperDC' else
+              "LEFT JOIN redness Y ON Y.region='%s' AND Y.num=800+X.%s"
               )% (region,col)
             ,"WHERE X."+col, "IS NOT NULL GROUP BY X.sourcefile, X."+col
             ,"UNION ALL"
         ]
     cur.execute(' '.join(sql[:-1]))
+    cur.execute("DROP TABLE denominators")
     conn.commit()
+    if bulk:
+        for name, value in pragmas:
+            cur.execute("PRAGMA %s=%s" % (name, value))
     conn.close()
 
 if __name__ == '__main__':
@@ -265,5 +264,8 @@ if __name__ == '__main__':
             """)
     )
     parser.add_argument("filename", nargs='?', default="RollingPoll.db", help="Output SQLite filename")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes to parse files")
+    parser.add_argument("-c", "--cachedir", help="Directory to keep parsed files in binary columnar format")
+    parser.add_argument("-b", "--bulk", action="store_true", help="Bulk load: relaxed journal and sync, index after loading")
     args = parser.parse_args()
-    buildsqlite(args.filename)
+    buildsqlite(args.filename, args.jobs, args.cachedir, args.bulk)
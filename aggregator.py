@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Aggregation of poll data into rows of the overall table with NumPy, as an
+# alternative to storing every row in SQLite and aggregating with SQL
+#
+
+import numpy
+
+# region code and its column of voting intention in poll data
+REGIONS = [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]
+NULL = -1 # for None in integer arrays
+
+def error_margin(z, n, p):
+    "Vectorized ERRMARGIN(z, n, p) of buildsqlite(), None where n is not positive"
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        margin = z*numpy.sqrt(p*(100.0-p)/n)
+    return [m if k > 0 else None for m, k in zip(margin.tolist(), n.tolist())]
+
+def percent(count, total):
+    "count*100/total as list, None where total is zero like division in SQLite"
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pct = count*100.0/total
+    return [p if t else None for p, t in zip(pct.tolist(), total.tolist())]
+
+class Aggregator:
+    '''Count the votes of each candidate in each sourcefile, with NumPy
+
+    Each file added is reduced to integer arrays of the region columns and a
+    float array of weight, tagged by an integer sourcefile index. rows() then
+    computes the same aggregates as the overall table of buildsqlite(), by
+    weighted bincount over (sourcefile, candidate) and over sourcefile for the
+    denominators. The rows are not kept after reduction.
+    '''
+    def __init__(self):
+        self.sourcefiles = []
+        self.fileindex = []
+        self.columns = {col:[] for _,col in REGIONS}
+        self.weights = []
+
+    def add(self, sourcefile, header, batches):
+        "Reduce the rows of a sourcefile, as returned by csvyreader.parse_all()"
+        rows = [row for batch in batches for row in batch]
+        for _,col in REGIONS:
+            if col in header:
+                n = header.index(col)
+                values = [NULL if row[n] is None else row[n] for row in rows]
+            else:
+                values = [NULL] * len(rows)
+            self.columns[col].append(numpy.array(values, dtype=numpy.int64))
+        n = header.index('weight')
+        self.weights.append(numpy.array([0.0 if row[n] is None else row[n] for row in rows], dtype=numpy.float64))
+        self.fileindex.append(numpy.full(len(rows), len(self.sourcefiles), dtype=numpy.int64))
+        self.sourcefiles.append(sourcefile)
+
+    def rows(self):
+        '''Return list of (region, sourcefile, num, votes, vote_pct, vote_err,
+        valid_vote_pct, valid_vote_err, adj_pct, adj_err, valid_adj_pct,
+        valid_adj_err, adj_neff, valid_adj_neff, adj_err_kish,
+        valid_adj_err_kish) in order of region, sourcefile and num, with
+        margins at 95% confidence level'''
+        if not self.sourcefiles:
+            return []
+        nfiles = len(self.sourcefiles)
+        fileindex = numpy.concatenate(self.fileindex)
+        weights = numpy.concatenate(self.weights)
+        order = sorted(range(nfiles), key=self.sourcefiles.__getitem__) # GROUP BY sourcefile
+        ret = []
+        for region, col in REGIONS:
+            codes = numpy.concatenate(self.columns[col])
+            answered = codes != NULL
+            valid = answered & (codes > 0) & (codes < 30)
+            # denominators of each sourcefile
+            total = numpy.bincount(fileindex[answered], minlength=nfiles)
+            total_valid = numpy.bincount(fileindex[valid], minlength=nfiles)
+            total_adj = numpy.bincount(fileindex[answered], weights[answered], minlength=nfiles)
+            total_valid_adj = numpy.bincount(fileindex[valid], weights[valid], minlength=nfiles)
+            total_adj2 = numpy.bincount(fileindex[answered], weights[answered]**2, minlength=nfiles)
+            total_valid_adj2 = numpy.bincount(fileindex[valid], weights[valid]**2, minlength=nfiles)
+            # votes of each (sourcefile, candidate)
+            nums, candidate = numpy.unique(codes[answered], return_inverse=True)
+            if not len(nums):
+                continue
+            group = fileindex[answered]*len(nums) + candidate.ravel()
+            votes = numpy.bincount(group, minlength=nfiles*len(nums))
+            adj = numpy.bincount(group, weights[answered], minlength=nfiles*len(nums))
+            group = numpy.array([f*len(nums)+c for f in order for c in range(len(nums))], dtype=numpy.int64)
+            group = group[votes[group] > 0]
+            f = group // len(nums)
+            votes, adj = votes[group], adj[group]
+            shares = []
+            for count, denominator in [(votes, total), (votes, total_valid), (adj, total_adj), (adj, total_valid_adj)]:
+                pct = percent(count, denominator[f])
+                shares += [pct, error_margin(1.96, denominator[f], numpy.array(pct, dtype=numpy.float64))]
+            # Kish's effective sample size of weighted shares, and margins with it
+            kish = []
+            for total, total2, pct in [(total_adj, total_adj2, shares[4]), (total_valid_adj, total_valid_adj2, shares[6])]:
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    neff = total[f]*total[f]/total2[f]
+                kish.append([n if t else None for n, t in zip(neff.tolist(), total2[f].tolist())])
+                kish.append(error_margin(1.96, neff, numpy.array(pct, dtype=numpy.float64)))
+            ret.extend(zip([region]*len(group), [self.sourcefiles[n] for n in f.tolist()],
+                           nums[group % len(nums)].tolist(), votes.tolist(), *(shares + kish[0::2] + kish[1::2])))
+        return ret
+
+if __name__ == '__main__':
+    # Benchmark: buildsqlite() against buildoverall() on the bundled snapshots,
+    # best of 3, parsing the CSVY text and then reading the columnar cache
+    import contextlib, io, sys, tempfile, time
+    from FrontlineTechWorkerRollingHelper import buildsqlite, buildoverall
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    def best(func, *args, **kwargs):
+        "Shortest time of repeated func(*args, **kwargs), and its connection"
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()): # names of files read
+                conn, _ = func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+        return min(times), conn
+    query = "SELECT * FROM overall ORDER BY region, daterange, num"
+    with tempfile.TemporaryDirectory() as cachedir:
+        for label, cache in [("parsing the CSVY text", None), ("from the columnar cache", cachedir)]:
+            sqltime, sqlconn = best(buildsqlite, ':memory:', True, bulk=True, cachedir=cache)
+            nptime, npconn = best(buildoverall, True, cachedir=cache)
+            same = list(sqlconn.execute(query)) == list(npconn.execute(query))
+            print("%s: buildsqlite(bulk) %.2fs, buildoverall %.2fs, overall %s" %
+                  (label, sqltime, nptime, "identical" if same else "DIFFERS"))
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Writing chart pages as separate assets: library JS under content-hashed
+# names, chart data as JSON loaded on demand by a small tabbed HTML shell, and
+# gzip/brotli copies of each file for web servers serving precompressed files;
+# and a cache of rendered fragments for regenerating only what has changed
+#
+
+import glob
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # only .gz copies are written
+
+def _bytes(data):
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+def write_file(path, data, precompress=True):
+    '''Write data (bytes, or str as UTF-8) to path, with path.gz and path.br
+    copies beside it if precompress. Return False without writing if path
+    already has the same content'''
+    data = _bytes(data)
+    if os.path.exists(path):
+        with open(path, 'rb') as fp:
+            if fp.read() == data:
+                return False
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    if not precompress:
+        return True
+    with open(path+'.gz', 'wb') as fp:
+        fp.write(gzip.compress(data, 9, mtime=0)) # no timestamp, same data gives same file
+    if brotli is not None:
+        with open(path+'.br', 'wb') as fp:
+            fp.write(brotli.compress(data))
+    return True
+
+def write_hashed(directory, filename, data):
+    '''Write data to directory under filename with a hash of the content
+    inserted before the extension, e.g. plotly.js as plotly.0123456789ab.js,
+    and return the hashed filename. Such a file never changes and can be cached
+    by browsers forever; it is not rewritten if it exists'''
+    data = _bytes(data)
+    stem, ext = os.path.splitext(filename)
+    hashedname = "%s.%s%s" % (stem, hashlib.sha256(data).hexdigest()[:12], ext)
+    path = os.path.join(directory, hashedname)
+    if not os.path.exists(path):
+        write_file(path, data)
+    return hashedname
+
+class FragmentCache:
+    '''On-disk cache of rendered fragments of chart pages, as text
+
+    Each fragment is saved in the cache directory under its key and the
+    fingerprint of the data it shows, e.g. by region_fingerprint(). get()
+    returns a fragment only if it was put with the same fingerprint, and put()
+    replaces all other fragments of the key. hits and misses count the get()
+    calls answered from disk and not.
+    '''
+    def __init__(self, directory='.chartcache'):
+        self.directory = directory
+        self.hits = self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, fingerprint):
+        return os.path.join(self.directory, "%s--%s" % (key, fingerprint))
+
+    def get(self, key, fingerprint):
+        "The fragment of key put with fingerprint, or None"
+        try:
+            with open(self._path(key, fingerprint), encoding='utf-8') as fp:
+                fragment = fp.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fragment
+
+    def put(self, key, fingerprint, fragment):
+        "Save fragment of key with fingerprint, and return it"
+        for path in glob.glob(glob.escape(os.path.join(self.directory, key)) + "--*"):
+            os.remove(path)
+        with open(self._path(key, fingerprint), 'w', encoding='utf-8') as fp:
+            fp.write(fragment)
+        return fragment
+
+def tab_css(ntabs):
+    "CSS of tabs made by tab_html(), with at most ntabs tabs in a group"
+    return '''
+.chart-tab-wrap {
+  -webkit-transition: 0.3s box-shadow ease;
+          transition: 0.3s box-shadow ease;
+  border-radius: 6px;
+  max-width: 100%;
+  display: -webkit-box;
+  display: -webkit-flex;
+  display: -ms-flexbox;
+  display: flex;
+  -webkit-flex-wrap: wrap;
+      -ms-flex-wrap: wrap;
+          flex-wrap: wrap;
+  position: relative;
+  list-style: none;
+  background-color: #fff;
+  margin: 40px 0;
+  box-shadow: 0 1px 3px rgba(0, 0, 0, 0.12), 0 1px 2px rgba(0, 0, 0, 0.24);
+}
+.chart-tab-wrap:hover {
+  box-shadow: 0 12px 23px rgba(0, 0, 0, 0.23), 0 10px 10px rgba(0, 0, 0, 0.19);
+}
+.chart-tab {
+  display: none;
+}
+''' + ''.join('''
+.chart-tab:checked:nth-of-type(%d) ~ .chart-tab__content:nth-of-type(%d) {
+  opacity: 1;
+  -webkit-transition: 0.5s opacity ease-in, 0.8s transform ease;
+          transition: 0.5s opacity ease-in, 0.8s transform ease;
+  position: relative;
+  top: 0;
+  z-index: 100;
+  -webkit-transform: translateY(0px);
+          transform: translateY(0px);
+  text-shadow: 0 0 0;
+}''' % (n+1,n+1) for n in range(ntabs)) + '''
+.chart-tab:first-of-type:not(:last-of-type) + label {
+  border-top-right-radius: 0;
+  border-bottom-right-radius: 0;
+}
+.chart-tab:not(:first-of-type):not(:last-of-type) + label {
+  border-radius: 0;
+}
+.chart-tab:last-of-type:not(:first-of-type) + label {
+  border-top-left-radius: 0;
+  border-bottom-left-radius: 0;
+}
+.chart-tab:checked + label {
+  background-color: #fff;
+  box-shadow: 0 -1px 0 #fff inset;
+  cursor: default;
+}
+.chart-tab:checked + label:hover {
+  box-shadow: 0 -1px 0 #fff inset;
+  background-color: #fff;
+}
+.chart-tab + label {
+  box-shadow: 0 -1px 0 #eee inset;
+  border-radius: 6px 6px 0 0;
+  cursor: pointer;
+  display: block;
+  text-decoration: none;
+  color: #333;
+  -webkit-box-flex: 3;
+  -webkit-flex-grow: 3;
+      -ms-flex-positive: 3;
+          flex-grow: 3;
+  text-align: center;
+  background-color: #f2f2f2;
+  -webkit-user-select: none;
+     -moz-user-select: none;
+      -ms-user-select: none;
+          user-select: none;
+  text-align: center;
+  -webkit-transition: 0.3s background-color ease, 0.3s box-shadow ease;
+  transition: 0.3s background-color ease, 0.3s box-shadow ease;
+  height: 50px;
+  box-sizing: border-box;
+  padding: 15px;
+}
+.chart-tab + label:hover {
+  background-color: #f9f9f9;
+  box-shadow: 0 1px 0 #f4f4f4 inset;
+}
+.chart-tab__content {
+  padding: 10px 25px;
+  background-color: transparent;
+  position: absolute;
+  width: 100%;
+  z-index: -1;
+  opacity: 0;
+  left: 0;
+  -webkit-transform: translateY(-3px);
+          transform: translateY(-3px);
+  border-radius: 6px;
+}
+.chart-container {
+  margin: 0 auto;
+  display: block;
+  width: 100%;
+}
+'''
+
+def tab_html(panels, prefix="tab"):
+    '''HTML of a group of tabs for list of (title, content HTML) in panels,
+    the first one checked. Nested groups need a different prefix'''
+    return '''
+<div class="chart-container">
+  <div class="chart-tab-wrap">
+''' + ''.join('''
+    <input type="radio" id="%s%d" name="%sGroup" class="chart-tab" %s>
+    <label for="%s%d">%s</label>
+''' % (prefix,n+1,prefix,('' if n else 'checked'),prefix,n+1,title) for n,(title,_) in enumerate(panels)) + ''.join('''
+    <div class="chart-tab__content">%s</div>
+''' % content for _,content in panels) + '''
+  </div>
+</div>
+'''
+
+def lazy_div(src):
+    "Placeholder in tab content for chart data to be loaded from src by LOADER_JS"
+    return '<div class="chart-lazy" data-src="%s"></div>' % src
+
+# Fetch the data of each placeholder by lazy_div() once its tab and all tabs
+# enclosing it are checked, and pass it to renderChart(element, data) which the
+# page defines
+LOADER_JS = '''
+function chartShown(content) {
+  for (; content; content = content.parentNode.closest('.chart-tab__content')) {
+    var wrap = content.parentNode;
+    var tabs = wrap.querySelectorAll(':scope > .chart-tab');
+    var contents = wrap.querySelectorAll(':scope > .chart-tab__content');
+    if (!tabs[Array.prototype.indexOf.call(contents, content)].checked) return false;
+  }
+  return true;
+}
+function chartLoad() {
+  document.querySelectorAll('.chart-lazy[data-src]').forEach(function(div) {
+    if (!chartShown(div.closest('.chart-tab__content'))) return;
+    var src = div.getAttribute('data-src');
+    div.removeAttribute('data-src');
+    fetch(src).then(function(response) { return response.json(); })
+              .then(function(data) { renderChart(div, data); });
+  });
+}
+document.addEventListener('change', chartLoad);
+document.addEventListener('DOMContentLoaded', chartLoad);
+'''
+
+def shell_html(body, ntabs, scripts=(), styles=(), js=''):
+    '''A small HTML page of body made by tab_html(), loading library scripts
+    and styles from list of URLs and running LOADER_JS with js that defines
+    renderChart()'''
+    return '<!DOCTYPE html>\n<html><head><meta charset="utf-8">' + \
+           ''.join('<link rel="stylesheet" href="%s" type="text/css">' % href for href in styles) + \
+           '<style>' + tab_css(ntabs) + '</style>' + \
+           ''.join('<script type="text/javascript" src="%s"></script>' % src for src in scripts) + \
+           '<script type="text/javascript">' + LOADER_JS + js + '</script>' + \
+           '</head><body>' + body + '</body></html>'
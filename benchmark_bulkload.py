@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Benchmark: the SQLite writers of the helper and of MakeSqlite.py with and
+# without bulk load, on all bundled snapshots, writing a database on disk.
+# Files are parsed once into a columnar cache beforehand, so the times are of
+# loading and aggregating. Usage: python benchmark_bulkload.py [repeat]
+#
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import FrontlineTechWorkerRollingHelper as helper
+import MakeSqlite
+
+def best(repeat, func, *args, **kwargs):
+    "Shortest time of repeated func(*args, **kwargs)"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # names of files read
+            func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def dump(dbname, tables):
+    "All rows of tables in dbname, in order, to compare databases"
+    conn = sqlite3.connect(dbname)
+    dumped = {table:sorted(conn.execute("SELECT * FROM %s" % table), key=repr) for table in tables}
+    conn.close()
+    return dumped
+
+def helper_build(dbname, cachedir, bulk):
+    conn, _ = helper.buildsqlite(dbname, True, cachedir=cachedir, bulk=bulk)
+    conn.close()
+
+def makesqlite_build(dbname, cachedir, bulk):
+    MakeSqlite.buildsqlite(dbname, 1, cachedir, bulk)
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cachedir = os.path.join(tmpdir, 'cache')
+        for label, build, tables in [("helper buildsqlite()", helper_build, ["poll", "overall"]),
+                                     ("MakeSqlite.py", makesqlite_build, ["poll", "overall"])]:
+            best(1, build, os.path.join(tmpdir, 'warm.db'), cachedir, False) # fill the columnar cache
+            times, dumps = {}, {}
+            for bulk in [False, True]:
+                dbname = os.path.join(tmpdir, 'bulk.db' if bulk else 'plain.db')
+                times[bulk] = best(repeat, build, dbname, cachedir, bulk)
+                dumps[bulk] = dump(dbname, tables)
+            rows = len(dumps[True]["poll"])
+            print("%s, %d poll rows: plain %.2fs, bulk %.2fs, speedup %.1fx, tables %s" %
+                  (label, rows, times[False], times[True], times[False]/times[True],
+                   "identical" if dumps[False] == dumps[True] else "DIFFER"))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Benchmark: aggregate_overall() on poll enlarged k times, by copying every
+# row of the bundled snapshots k times within its sourcefile. Only the grouped
+# aggregation into overall is timed, best of repeat, not the reading of files
+# or the ranking. Usage: python benchmark_overall.py [repeat]
+#
+
+import contextlib
+import io
+import sys
+import time
+
+from FrontlineTechWorkerRollingHelper import aggregate_overall, buildsqlite
+
+def aggregate(cur):
+    "Time aggregate_overall() of all sourcefiles into a new overall table"
+    cur.execute("DROP TABLE IF EXISTS overall")
+    cur.execute("CREATE TEMP TABLE newfiles AS SELECT sourcefile FROM manifest")
+    start = time.perf_counter()
+    aggregate_overall(cur)
+    elapsed = time.perf_counter() - start
+    cur.execute("DROP TABLE newfiles")
+    return elapsed
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with contextlib.redirect_stdout(io.StringIO()): # names of files read
+        conn, cur = buildsqlite(':memory:', True)
+    query = "SELECT * FROM overall ORDER BY region, daterange, num"
+    built = list(cur.execute(query))
+    aggregate(cur)
+    print("overall of the bundled snapshots %s" % ("identical" if list(cur.execute(query)) == built else "DIFFERS"))
+    cur.execute("CREATE TEMP TABLE original AS SELECT * FROM poll")
+    copies = 1
+    for k in [1, 2, 4, 8, 16]:
+        for copies in range(copies, k):
+            cur.execute("INSERT INTO poll SELECT * FROM original")
+        copies = k
+        rows, = cur.execute("SELECT COUNT(*) FROM poll").fetchone()
+        elapsed = min(aggregate(cur) for _ in range(repeat))
+        print("x%-2d %6d poll rows: overall aggregated in %.3fs, %.2fus per row" %
+              (k, rows, elapsed, elapsed*1e6/rows))
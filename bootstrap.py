@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Weighted bootstrap of candidate shares in each rolling window, with NumPy
+#
+
+import concurrent.futures
+import zlib
+
+import numpy
+
+NULL = -1 # for None in integer arrays
+VARIANTS = ["adj", "valid_adj"] # named as in ranking table
+
+def ranked(variant, nums):
+    "Mask of nums that are ranked in a variant, as in ranking table"
+    if variant.startswith("valid_"):
+        return (nums > 0) & (nums < 30)
+    return (nums < 30) | (nums == 8888)
+
+def resample(codes, weights, replicates, rng, blocksize=1000):
+    '''Return (nums, totals) where totals[b, k] is the sum of weights of
+    respondents answering nums[k] in bootstrap replicate b
+
+    Each replicate draws len(codes) respondents with replacement. Replicates
+    are drawn in blocks of blocksize as a matrix of respondent indices and
+    summed by one bincount over (replicate, candidate) '''
+    nums, candidate = numpy.unique(codes, return_inverse=True)
+    candidate = candidate.ravel()
+    n, k = len(codes), len(nums)
+    totals = numpy.empty((replicates, k), dtype=numpy.float64)
+    for start in range(0, replicates, blocksize):
+        block = min(blocksize, replicates-start)
+        draws = rng.integers(0, n, size=(block, n), dtype=numpy.int32)
+        group = (numpy.arange(block)[:, None]*k + candidate[draws]).ravel()
+        totals[start:start+block] = numpy.bincount(group, weights[draws].ravel(), minlength=block*k).reshape(block, k)
+    return nums, totals
+
+def intervals(task):
+    '''Bootstrap one (key, codes, weights, replicates, seed, level) task,
+    return (key, shares, leads) where shares is list of (variant, num, pct,
+    pct_lo, pct_hi) and leads is list of (variant, num, rival, lead, lead_lo,
+    lead_hi) for num before rival, all in percentage points'''
+    key, codes, weights, replicates, seed, level = task
+    answered = codes != NULL
+    codes, weights = codes[answered], weights[answered]
+    shares, leads = [], []
+    if not len(codes):
+        return key, shares, leads
+    # seeded by the key, so results do not depend on order or number of jobs
+    rng = numpy.random.default_rng([seed, zlib.crc32(repr(key).encode('utf-8'))])
+    nums, totals = resample(codes, weights, replicates, rng)
+    point = numpy.bincount(numpy.searchsorted(nums, codes), weights, minlength=len(nums))
+    tails = [(100.0-level)/2, (100.0+level)/2]
+    for variant in VARIANTS:
+        pick = ranked(variant, nums)
+        denominator = point.sum() if variant == "adj" else point[(nums > 0) & (nums < 30)].sum()
+        if not pick.any() or not denominator:
+            continue
+        pct = point[pick]*100.0/denominator
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # replicates drawing nobody of the denominator are dropped
+            base = totals.sum(axis=1) if variant == "adj" else totals[:, (nums > 0) & (nums < 30)].sum(axis=1)
+            # one row per candidate, so percentiles run along contiguous memory
+            sample = (totals[base > 0][:, pick]*100.0/base[base > 0, None]).T.copy()
+        lo, hi = numpy.percentile(sample, tails, axis=1)
+        shares += zip([variant]*len(pct), nums[pick].tolist(), pct.tolist(), lo.tolist(), hi.tolist())
+        i, j = numpy.triu_indices(len(pct), 1)
+        lead_lo, lead_hi = numpy.percentile(sample[i] - sample[j], tails, axis=1)
+        leads += zip([variant]*len(i), nums[pick][i].tolist(), nums[pick][j].tolist(),
+                     (pct[i]-pct[j]).tolist(), lead_lo.tolist(), lead_hi.tolist())
+    return key, shares, leads
+
+def bootstrap_all(windows, replicates=10000, seed=0, level=95, jobs=1):
+    '''Generator of (key, shares, leads) as returned by intervals() for each
+    (key, codes, weights) in windows, in the same order
+
+    codes and weights are arrays of the answers of respondents in a window,
+    with NULL for no answer. With jobs > 1, windows are bootstrapped in a pool
+    of worker processes '''
+    tasks = ((key, codes, weights, replicates, seed, level) for key, codes, weights in windows)
+    if jobs <= 1:
+        yield from map(intervals, tasks)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(intervals, tasks)
+
+if __name__ == '__main__':
+    # Benchmark: bootstrap all windows of all regions of a database by buildsqlite()
+    import sqlite3, sys, time
+    dbname = sys.argv[1] if len(sys.argv) > 1 else 'poll.db'
+    replicates = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    regions = [("HKIsland","R2"),("KlnWest","R3"),("KlnEast","R4"),("NTWest","R5"),("NTEast","R6"),("SuperDC","R8")]
+    cur = sqlite3.connect(dbname).cursor()
+    start = time.perf_counter()
+    windows = []
+    for sourcefile, in cur.execute("SELECT sourcefile FROM manifest ORDER BY sourcefile").fetchall():
+        rows = cur.execute("SELECT weight,%s FROM poll WHERE sourcefile=?" % ",".join(col for _,col in regions), (sourcefile,)).fetchall()
+        weights = numpy.array([0.0 if row[0] is None else row[0] for row in rows], dtype=numpy.float64)
+        for n, (region, _) in enumerate(regions, 1):
+            codes = numpy.array([NULL if row[n] is None else row[n] for row in rows], dtype=numpy.int64)
+            windows.append(((region, sourcefile), codes, weights))
+    loaded = time.perf_counter()
+    count = sum(len(shares) for _, shares, _ in bootstrap_all(windows, replicates, jobs=jobs))
+    done = time.perf_counter()
+    print("%d windows, %d respondents, %d replicates, %d jobs" % (len(windows), sum((c != NULL).sum() for _, c, _ in windows), replicates, jobs))
+    print("load %.2fs, bootstrap %.2fs, %d intervals" % (loaded-start, done-loaded, count))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Binary columnar cache of parsed CSVY data, loaded by memory-mapping
+#
+# File layout: 8 bytes magic, 8 bytes little-endian length of JSON metadata,
+# the JSON metadata, then one fixed-width array per column, each aligned to 8
+# bytes. Columns of int are stored in the narrowest of int8 to int64 that fits
+# (with the minimum of the type for None), columns of float as float64 (NaN
+# for None), and any other column as int32 codes into a dictionary of values
+# kept in the metadata.
+#
+
+import array
+import datetime
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'CSVYCOL1'
+INT_TYPES = [('b', 8), ('h', 16), ('i', 32), ('q', 64)] # (typecode, bits)
+
+def _encode_column(values):
+    "Return (metadata, array) of a column of values"
+    kinds = set(type(v) for v in values if v is not None)
+    notnull = [v for v in values if v is not None]
+    if kinds <= {int} and notnull:
+        low, high = min(notnull), max(notnull)
+        for typecode, bits in INT_TYPES:
+            null = -2**(bits-1)
+            if null < low and high < 2**(bits-1):
+                data = array.array(typecode, [null if v is None else v for v in values])
+                return {'type':'int', 'null':null}, data
+    elif kinds <= {float}:
+        return {'type':'float64'}, array.array('d', [math.nan if v is None else v for v in values])
+    # dictionary coding, dates are kept as ISO string in the dictionary
+    isdate = kinds == {datetime.date}
+    # keyed also by type, as 1 and 1.0 of a column of both are equal keys
+    codes, dictionary = {}, []
+    for v in values:
+        if (type(v), v) not in codes:
+            codes[type(v), v] = len(dictionary)
+            dictionary.append(v.isoformat() if isdate and v is not None else v)
+    meta = {'type':'dict', 'values':dictionary, 'date':isdate}
+    return meta, array.array('i', [codes[type(v), v] for v in values])
+
+def save(path, fields_def_yaml, header, batches):
+    "Write parsed CSVY data, as returned by csvyreader.parse_text(), to path"
+    rows = [row for batch in batches for row in batch]
+    columns = list(zip(*rows)) if rows else [() for _ in header]
+    meta = {'fields_def_yaml':fields_def_yaml, 'header':header, 'nrows':len(rows), 'columns':[]}
+    arrays = []
+    offset = 0
+    for values in columns:
+        colmeta, data = _encode_column(values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        colmeta.update(offset=offset, typecode=data.typecode)
+        meta['columns'].append(colmeta)
+        arrays.append(data)
+        offset += -(-len(data)*data.itemsize // 8) * 8
+    metatext = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    metatext += b' ' * (-len(metatext) % 8)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as fp:
+        fp.write(MAGIC + struct.pack('<Q', len(metatext)) + metatext)
+        for data in arrays:
+            raw = data.tobytes()
+            fp.write(raw + b'\0' * (-len(raw) % 8))
+    os.replace(tmppath, path)
+
+class ColumnarData:
+    '''Memory-mapped parsed CSVY data saved by save()
+
+    The file is mapped read-only, so loading costs only reading the metadata
+    and the column pages are shared between processes. columns[i] is a
+    memoryview of the raw array; use batches() to get rows as tuples.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:8] != MAGIC:
+            raise ValueError("%s is not a columnar cache file" % path)
+        metalen, = struct.unpack('<Q', self._mmap[8:16])
+        meta = json.loads(self._mmap[16:16+metalen].decode('utf-8'))
+        self.fields_def_yaml = meta['fields_def_yaml']
+        self.header = meta['header']
+        self.nrows = meta['nrows']
+        self.meta = meta['columns']
+        start = 16 + metalen
+        view = memoryview(self._mmap)
+        self.columns = []
+        for colmeta in self.meta:
+            itemsize = array.array(colmeta['typecode']).itemsize
+            begin = start + colmeta['offset']
+            self.columns.append(view[begin:begin+self.nrows*itemsize].cast(colmeta['typecode']))
+            if colmeta['type'] == 'dict' and colmeta['date']:
+                colmeta['values'] = [None if v is None else datetime.date.fromisoformat(v)
+                                     for v in colmeta['values']]
+
+    def column(self, n, start=0, stop=None):
+        "Return the values of column n as a list, in row range [start, stop)"
+        colmeta = self.meta[n]
+        values = self.columns[n][start:stop].tolist()
+        if colmeta['type'] == 'int':
+            null = colmeta['null']
+            return [None if v == null else v for v in values]
+        elif colmeta['type'] == 'float64':
+            return [None if v != v else v for v in values] # NaN is None
+        dictionary = colmeta['values']
+        return [dictionary[v] for v in values]
+
+    def batches(self, batchsize=4096):
+        "Generator of lists of row tuples, like csvyreader.coerced_batches()"
+        for start in range(0, self.nrows, batchsize):
+            stop = min(start+batchsize, self.nrows)
+            yield list(zip(*[self.column(n, start, stop) for n in range(len(self.columns))]))
+
+def load(path):
+    "Memory-map a columnar cache file, return ColumnarData"
+    return ColumnarData(path)
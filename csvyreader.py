@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Streaming reader of CSVY files (YAML metadata header + CSV data) as
+# published by HKU POP, shared by MakeSqlite.py, MakeExcel.py and
+# FrontlineTechWorkerRollingHelper.py
+#
+
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+
+from datetime import datetime
+
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader # libyaml, if available
+except ImportError:
+    from yaml import SafeLoader
+
+import colcache
+
+# parsed field definitions as JSON text, keyed by SHA-256 of the YAML header
+FIELDS_CACHE = '.csvy_fields_cache.json'
+_fields_cache = {}
+_persist = True # False in worker processes of parse_all(): only the parent writes FIELDS_CACHE
+
+def _load_fields_cache():
+    "Read the persistent cache of field definitions into memory, once"
+    if not _fields_cache:
+        try:
+            with open(FIELDS_CACHE, encoding='utf-8') as fp:
+                _fields_cache.update(json.load(fp))
+        except (OSError, ValueError):
+            pass
+
+def _save_fields_cache():
+    "Write the cache of field definitions to disk atomically, through a temp file of its own"
+    directory, filename = os.path.split(os.path.abspath(FIELDS_CACHE))
+    try:
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix=filename+'.', suffix='.tmp')
+    except OSError:
+        return # cache is best effort
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            json.dump(_fields_cache, fp, ensure_ascii=False)
+        os.replace(tmppath, FIELDS_CACHE)
+    except OSError:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+def _init_worker():
+    "Initializer of worker processes of parse_all(): parse headers in memory only"
+    global _persist
+    _persist = False
+
+def parse_fields(fields_def_yaml):
+    '''Parse the YAML metadata lines and return the list of field definitions
+
+    The same header is parsed only once: results are memoized by hash of the
+    header text, in memory and in FIELDS_CACHE across runs (written only by the
+    parent process of parse_all()). Each call returns a fresh copy so the
+    caller may modify it.
+    '''
+    text = "\n".join(fields_def_yaml)
+    key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    _load_fields_cache()
+    if key not in _fields_cache:
+        fields_def = yaml.load(text, Loader=SafeLoader)
+        assert('fields' in fields_def)
+        assert(all('name' in f for f in fields_def['fields']))
+        _fields_cache[key] = json.dumps(fields_def['fields'], ensure_ascii=False)
+        if _persist:
+            _save_fields_cache()
+    return json.loads(_fields_cache[key])
+
+def sha256sum(fileobj, blocksize=1<<20):
+    "SHA-256 of the UTF-8 content of a seekable text file object, rewound afterwards"
+    digest = hashlib.sha256()
+    for block in iter(lambda: fileobj.read(blocksize), ''):
+        digest.update(block.encode('utf-8'))
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+class CSVYReader:
+    '''Read a CSVY file object once, from top to bottom
+
+    The YAML metadata is read eagerly on construction, either in the form of
+    comment lines bounded by "#---" or plain lines bounded by "---". The CSV
+    header row is then read together with the first data row so that a short
+    header can be right-aligned. Data rows are produced lazily by iterating
+    the reader, hence only one row is held in memory at a time.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fields_def_yaml = self._read_metadata()
+        lines = itertools.chain([self._pending], fileobj) if self._pending else fileobj
+        self._csv = csv.reader(lines)
+        self.header = next(self._csv, [])
+        self._first = next(self._csv, [])
+        if len(self.header) < len(self._first):
+            # in case header row is shorter, align to right; padded columns are None
+            self.header = [None] * (len(self._first) - len(self.header)) + self.header
+
+    def _read_metadata(self):
+        "Consume the metadata lines from file and return them without delimiters"
+        lines = []
+        line = self.fileobj.readline()
+        if line.startswith('#'):
+            # metadata in comment, delimited by "#---" at first and last line
+            while line.startswith('#'):
+                lines.append(line[1:].rstrip('\r\n'))
+                line = self.fileobj.readline()
+            self._pending = line # the CSV header row
+            return lines[1:-1]
+        # the metadata is not in comment, look for limiters instead
+        line = self.fileobj.readline()
+        while line and not line.startswith('---'):
+            lines.append(line.rstrip('\r\n'))
+            line = self.fileobj.readline()
+        self._pending = None
+        return lines
+
+    def fields(self):
+        "Parse the metadata and return the list of field definitions"
+        return parse_fields(self.fields_def_yaml)
+
+    def __iter__(self):
+        "Generate each non-empty data row as list of strings"
+        if self._first:
+            yield self._first
+        for row in self._csv:
+            if row:
+                yield row
+
+NULLS = ('', 'NA')
+
+def guess_value(value):
+    "Convert a string of unknown type into int, float, string or None"
+    if value in NULLS:
+        return None
+    elif value.isdigit():
+        return int(value)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+class Coercer:
+    '''Convert batches of CSV rows into typed tuples, column by column
+
+    The converter of each column is chosen once from the field definitions:
+    numeric fields become int, or float if the first batch with values in the
+    column has a number that is not integer, and keep that type in all later
+    batches; cells of numeric fields that are not numbers of the type, such as
+    "DK", are converted by guess_value() instead. The "date" column is
+    converted by dateconv with memoization as there are only a few distinct
+    dates; character fields are kept as string. Columns without definition
+    are converted cell by cell using guess_value(). "NA" and empty strings
+    become None in all cases.
+    '''
+    def __init__(self, fields, header, dateconv):
+        classes = {f['name']:f.get('class') for f in fields}
+        self.dateconv = dateconv
+        self._dates = {}
+        self.width = len(header)
+        self.converters = []
+        for h in header:
+            if h == 'date':
+                self.converters.append(self.dates)
+            elif classes.get(h) == 'numeric':
+                self.converters.append(self.numeric())
+            elif classes.get(h) == 'character':
+                self.converters.append(self.character)
+            else:
+                self.converters.append(self.guess)
+
+    @staticmethod
+    def numeric():
+        "Return the converter of a numeric column, which fixes its type on first use"
+        kind = None
+        def convert(column):
+            nonlocal kind
+            if kind is None:
+                if all(v in NULLS for v in column):
+                    return [None] * len(column)
+                kind = int
+                try:
+                    return [None if v in NULLS else int(v) for v in column]
+                except ValueError:
+                    kind = float
+            try:
+                return [None if v in NULLS else kind(v) for v in column]
+            except ValueError:
+                return [None if v in NULLS else Coercer._number(kind, v) for v in column]
+        return convert
+
+    @staticmethod
+    def _number(kind, value):
+        "Convert a cell of a numeric column by kind, or by guess_value() if not a number of the kind"
+        try:
+            return kind(value)
+        except ValueError:
+            return guess_value(value)
+
+    @staticmethod
+    def character(column):
+        return [None if v in NULLS else v for v in column]
+
+    @staticmethod
+    def guess(column):
+        return [guess_value(v) for v in column]
+
+    def dates(self, column):
+        for v in set(column).difference(self._dates):
+            self._dates[v] = None if v in NULLS else self.dateconv(v)
+        return [self._dates[v] for v in column]
+
+    def __call__(self, rows):
+        "Convert a list of rows of strings into a list of tuples"
+        if not rows:
+            return []
+        # pad short rows, truncate long rows, and transpose into columns
+        columns = zip(*[row+['']*(self.width-len(row)) if len(row) < self.width else row for row in rows])
+        return list(zip(*[conv(list(col)) for conv, col in zip(self.converters, columns)]))
+
+def coerced_batches(reader, dateconv, batchsize=4096):
+    "Generator of lists of typed tuples from a CSVYReader, converted with Coercer"
+    coercer = Coercer(reader.fields(), reader.header, dateconv)
+    rows = iter(reader)
+    while True:
+        batch = list(itertools.islice(rows, batchsize))
+        if not batch:
+            break
+        yield coercer(batch)
+
+def coerced(reader, dateconv, batchsize=4096):
+    "Generator of typed tuples from a CSVYReader, converted in batches with Coercer"
+    for batch in coerced_batches(reader, dateconv, batchsize):
+        yield from batch
+
+def isodate(value):
+    "Convert a yyyymmdd date into ISO format string, as stored in SQLite"
+    return datetime.strptime(value, "%Y%m%d").strftime("%Y-%m-%d")
+
+def pydate(value):
+    "Convert a yyyymmdd date into datetime.date object, as written to Excel"
+    return datetime.strptime(value, "%Y%m%d").date()
+
+def parse_text(text, dateconv, batchsize=4096):
+    '''Parse and coerce a whole CSVY file content, return (fields_def_yaml,
+    header, batches); run in worker process by parse_all()'''
+    reader = CSVYReader(io.StringIO(text, newline=''))
+    return reader.fields_def_yaml, reader.header, list(coerced_batches(reader, dateconv, batchsize))
+
+def parse_all(sources, dateconv, jobs=1, batchsize=4096, cachedir=None):
+    '''Generator of (key, fields_def_yaml, header, batches) for each (key,
+    fileobj) in sources, in the same order
+
+    With jobs > 1, files are read in this process but parsed and coerced in a
+    pool of worker processes, and at most 2*jobs files are in flight. With
+    cachedir, each parsed file is saved there in binary columnar format named
+    by its content hash, and memory-mapped instead of parsed next time.
+    Otherwise files are parsed here lazily and batches is a generator, which
+    must be consumed before the next item is requested'''
+    if jobs <= 1 and not cachedir:
+        for key, fileobj in sources:
+            reader = CSVYReader(fileobj)
+            yield key, reader.fields_def_yaml, reader.header, coerced_batches(reader, dateconv, batchsize)
+        return
+    if cachedir:
+        os.makedirs(cachedir, exist_ok=True)
+    def finish(key, path, job):
+        "Return the parse result, from cache or from job which is result or future"
+        if job is None:
+            data = colcache.load(path)
+            return key, data.fields_def_yaml, data.header, data.batches(batchsize)
+        result = job.result() if isinstance(job, concurrent.futures.Future) else job
+        if path:
+            colcache.save(path, *result)
+        return (key,) + result
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) if jobs > 1 else None
+    try:
+        pending = collections.deque()
+        for key, fileobj in sources:
+            path = None
+            if cachedir:
+                filename = "%s.%s.col" % (sha256sum(fileobj), dateconv.__name__)
+                path = os.path.join(cachedir, filename)
+            if path and os.path.exists(path):
+                job = None
+            elif executor:
+                job = executor.submit(parse_text, fileobj.read(), dateconv, batchsize)
+            else:
+                job = parse_text(fileobj.read(), dateconv, batchsize)
+            pending.append((key, path, job))
+            if len(pending) >= (2*jobs if executor else 1):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        if executor:
+            executor.shutdown()
+
+if __name__ == '__main__':
+    # Benchmark: cell-by-cell conversion against Coercer on a CSVY file
+    import sys, time
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'LC2016_final_20160730_0902_master_v1_POP.csvy'
+    with open(filename, encoding='utf-8', newline='') as fileobj:
+        reader = CSVYReader(fileobj)
+        header, rows = reader.header, list(reader)
+    fields = parse_fields(reader.fields_def_yaml)
+    start = time.perf_counter()
+    for row in rows:
+        [isodate(v) if h == 'date' and v not in NULLS else guess_value(v) for h, v in zip(header, row)]
+    percell = time.perf_counter() - start
+    start = time.perf_counter()
+    coercer = Coercer(fields, header, isodate)
+    for n in range(0, len(rows), 4096):
+        coercer(rows[n:n+4096])
+    columnar = time.perf_counter() - start
+    print("%s: %d rows x %d columns" % (filename, len(rows), len(header)))
+    print("cell by cell %.3fs, columnar %.3fs, speedup %.1fx" % (percell, columnar, percell/columnar))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Concurrent HTTP downloader for the HKU POP data files, with on-disk cache
+#
+
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+class Fetcher:
+    '''Download URLs with a bounded pool of threads
+
+    Each worker thread keeps one keep-alive connection per host and reuses it
+    for all its requests. Every request has a timeout, and connection errors
+    or server errors (5xx) are retried with a growing delay.
+    '''
+    def __init__(self, workers=4, timeout=30, retries=3, backoff=0.5):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        "Return the keep-alive connection of this thread to the host"
+        conns = self._local.__dict__.setdefault('conns', {})
+        if (scheme, netloc) not in conns:
+            conncls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[scheme, netloc] = conncls(netloc, timeout=self.timeout)
+        return conns[scheme, netloc]
+
+    def _drop_connection(self, scheme, netloc):
+        "Close and forget a broken connection, so next request opens a new one"
+        conns = self._local.__dict__.get('conns', {})
+        conn = conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, url, headers=None, redirects=5):
+        "GET a URL, return (status, response headers, body bytes) with retries and redirects"
+        for attempt in range(self.retries+1):
+            parts = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            try:
+                conn = self._connection(parts.scheme, parts.netloc)
+                conn.request('GET', path, headers=dict(headers or {}))
+                resp = conn.getresponse()
+                body = resp.read()
+                if resp.will_close:
+                    self._drop_connection(parts.scheme, parts.netloc)
+            except (OSError, http.client.HTTPException):
+                self._drop_connection(parts.scheme, parts.netloc)
+                if attempt == self.retries:
+                    raise
+            else:
+                if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+                    location = urllib.parse.urljoin(url, resp.getheader('Location'))
+                    return self.request(location, headers, redirects-1)
+                if resp.status < 500 or attempt == self.retries:
+                    break
+            time.sleep(self.backoff * 2**attempt)
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return resp.status, resp.headers, body
+
+    def fetch(self, url):
+        "Download one URL and return it as text"
+        return self.request(url)[2].decode('utf-8')
+
+    def map(self, func, urls):
+        '''Generator of (url, func(url)) in the same order as urls, each yielded as
+        soon as it and all before it are done while the rest continue in background'''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [(url, executor.submit(func, url)) for url in urls]
+            try:
+                for url, future in futures:
+                    yield url, future.result()
+            finally:
+                for _, future in futures:
+                    future.cancel()
+
+    def fetch_all(self, urls):
+        "Generator of (url, text) in the same order as urls, downloaded concurrently"
+        return self.map(self.fetch, urls)
+
+class DownloadCache:
+    '''On-disk cache of downloaded files, refreshed with conditional GET
+
+    Each URL is saved under its basename in the cache directory, and an index
+    file remembers its ETag, Last-Modified and SHA-256 of content. A refresh
+    sends If-None-Match/If-Modified-Since so only changed files are transferred.
+    After fetching, status[url] tells whether the file is "new", "changed" or
+    "unchanged" since the last run.
+    '''
+    def __init__(self, directory='.', fetcher=None, indexname='.download_cache.json'):
+        self.directory = directory
+        self.fetcher = fetcher or Fetcher()
+        self.indexpath = os.path.join(directory, indexname)
+        self.status = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.indexpath, encoding='utf-8') as fp:
+                self.index = json.load(fp)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def filename(self, url):
+        "Path to the local copy of a URL"
+        return os.path.join(self.directory, os.path.basename(urllib.parse.urlsplit(url).path))
+
+    def save(self):
+        "Write the index to disk atomically"
+        with self._lock:
+            tmppath = self.indexpath + '.tmp'
+            with open(tmppath, 'w', encoding='utf-8') as fp:
+                json.dump(self.index, fp, indent=1, sort_keys=True)
+            os.replace(tmppath, self.indexpath)
+
+    def fetch(self, url):
+        "Download a URL unless the cached copy is still valid, return the text"
+        path = self.filename(url)
+        with self._lock:
+            entry = self.index.get(url) if os.path.exists(path) else None
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        status, respheaders, body = self.fetcher.request(url, headers)
+        if status == 304:
+            with open(path, 'rb') as fp:
+                body = fp.read()
+            state = 'unchanged'
+        else:
+            sha256 = hashlib.sha256(body).hexdigest()
+            state = 'new' if not entry else 'unchanged' if entry['sha256'] == sha256 else 'changed'
+            if state != 'unchanged':
+                with open(path, 'wb') as fp:
+                    fp.write(body)
+            entry = dict(sha256=sha256,
+                         etag=respheaders.get('ETag'),
+                         last_modified=respheaders.get('Last-Modified'))
+        with self._lock:
+            self.index[url] = entry
+            self.status[url] = state
+        return body.decode('utf-8')
+
+    def fetch_all(self, urls):
+        "Generator of (url, text) in the same order as urls, refreshed concurrently"
+        try:
+            for url, text in self.fetcher.map(self.fetch, urls):
+                yield url, text
+        finally:
+            self.save()
+
+    def changed(self):
+        "List of URLs that are new or changed in this run"
+        return [url for url, state in self.status.items() if state != 'unchanged']
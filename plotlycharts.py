@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Plot.ly charts of the rolling poll trends of a region, for MakeHtmlPlotly.py.
+# Kept in a module of its own so that worker processes started by any method,
+# including spawn on Windows and macOS, can import the render functions
+#
+
+import json
+import sqlite3
+import time
+import urllib.parse
+
+import plotly.utils
+import plotly.offline.offline as po
+import plotly.graph_objs as go
+
+from FrontlineTechWorkerRollingHelper import QueryCache, getcolour
+
+def to_rgba(colourstr,alpha):
+    rr = int(colourstr[1:3],16)
+    gg = int(colourstr[3:5],16)
+    bb = int(colourstr[5:7],16)
+    return "rgba(%d,%d,%d,%f)" % (rr,gg,bb,alpha)
+
+def render_region(queries, title, code, seats):
+    "Return the div and the figure as JSON of the chart of a region"
+    trends = queries.get_region_trends(code)
+    top_candids = set(n for _,n in sorted([(pcts[-1],n) for n,(_,_,_,pcts,_) in trends.items()], reverse=True)[:seats])
+    earliest_date = min(dates[0] for _,_,dates,_,_ in trends.values())
+    latest_date = max(dates[-1] for _,_,dates,_,_ in trends.values())
+    components = []
+
+    # for each candidate, find the trend line and error region
+    for n, (name, redness, dates, pcts, errs) in trends.items():
+        colour = getcolour(redness)
+        x_val = [d.strftime("%Y-%m-%d") for d in dates]
+        y_val = pcts
+        y_upper = [p+e for p,e in zip(pcts,errs)]
+        y_lower = [max(p-e,0.0) for p,e in zip(pcts,errs)]
+        y_text = ["%.1f\u00B1%.1f%%" % (p,e) for p,e in zip(pcts,errs)]
+        line = go.Scatter(
+            legendgroup = name,
+            showlegend = True,
+            name = "%d %s" % (n, name),
+            visible = True if n in top_candids else 'legendonly',
+            x = x_val,
+            y = y_val,
+            text = y_text,
+            hoverinfo = "x+text+name",
+            mode = 'lines+markers',
+            line = {'color':colour, 'width':2, 'shape':'spline'}
+        )
+        shade = go.Scatter(
+            legendgroup = name,
+            showlegend = False,
+            hoverinfo = "none",
+            visible = True if n in top_candids else 'legendonly',
+            x = x_val + x_val[::-1],
+            y = y_upper + y_lower[::-1],
+            fill = 'tozerox',
+            fillcolor = to_rgba(colour,0.3),
+            line = go.Line(color='transparent')
+        )
+        components.extend([line,shade])
+
+    # Plot the chart with all components found
+    layout = dict(
+        title = title,
+        hovermode = 'compare',
+        xaxis = dict(title = "滾動民調日期", tickangle=45, tickformat="%d %b", hoverformat='%d %b'),
+        yaxis = dict(title = "支持度%", hoverformat='.2f')
+    )
+    # to display in Jupyter directly instead of generating HTML code:
+    #    po.iplot(dict(data=components, layout=layout), filename='hkisland')
+    fig = dict(data=components, layout=layout)
+    return po.plot(fig, output_type="div", include_plotlyjs=False), \
+           json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder, separators=(',',':'))
+
+queries = None # of this process, set by open_readonly()
+
+def open_readonly(dbname):
+    "Initializer of a worker process: query from a read-only connection of its own"
+    global queries
+    queries = QueryCache(sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(dbname), uri=True))
+
+def render_task(task):
+    '''Render a region of (title, code, seats) with the connection opened by
+    open_readonly(), return (div, figure JSON, seconds taken)'''
+    start = time.perf_counter()
+    divhtml, figjson = render_region(queries, *task)
+    return divhtml, figjson, time.perf_counter()-start
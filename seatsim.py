@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Monte Carlo simulation of seat allocation in geographical constituencies by
+# largest remainder with Hare quota, with NumPy
+#
+
+import concurrent.futures
+import zlib
+
+import numpy
+
+def hare_seats(shares, seats):
+    '''Allocate seats by largest remainder with Hare quota, for each row of
+    shares (array of simulations x candidates); return int array of same shape
+
+    Each candidate list first gets the whole quotas in its share, then the
+    seats left go to the largest remainders. Remainders are ranked once per
+    row by a stable sort, so of lists with equal remainders the earlier one
+    wins, and exactly the number of seats left are given '''
+    quotas = shares * (seats / shares.sum(axis=1, keepdims=True))
+    won = numpy.floor(quotas)
+    remainder = quotas - won
+    left = seats - won.sum(axis=1).astype(numpy.int64)
+    order = numpy.argsort(-remainder, axis=1, kind='stable')
+    rank = numpy.empty_like(order)
+    numpy.put_along_axis(rank, order, numpy.arange(order.shape[1])[None, :], axis=1)
+    won += rank < left[:, None]
+    return won.astype(numpy.int64)
+
+def simulate(task):
+    '''Simulate one (key, nums, pct, neff, blocs, seats, simulations, seed)
+    task, return (key, candidates, blocs) where candidates is list of (num,
+    mean seats, probability of winning a seat) and blocs is list of (bloc,
+    seats, probability) for 0 to seats seats
+
+    Share vectors are drawn from Dirichlet distribution with concentration
+    pct/100*neff, which has the mean of the poll shares and the variance of a
+    sample of neff respondents. Draws are made in blocks of 100000 '''
+    key, nums, pct, neff, blocs, seats, simulations, seed = task
+    rng = numpy.random.default_rng([seed, zlib.crc32(repr(key).encode('utf-8'))])
+    alpha = numpy.asarray(pct, dtype=numpy.float64) * (neff/100.0)
+    blocs = numpy.asarray(blocs, dtype=numpy.int64)
+    won = numpy.zeros(len(nums), dtype=numpy.int64)
+    winners = numpy.zeros(len(nums), dtype=numpy.int64)
+    labels = sorted(set(blocs.tolist()))
+    distribution = {bloc:numpy.zeros(seats+1, dtype=numpy.int64) for bloc in labels}
+    for start in range(0, simulations, 100000):
+        block = min(100000, simulations-start)
+        allocation = hare_seats(rng.gamma(alpha, size=(block, len(alpha))), seats)
+        won += allocation.sum(axis=0)
+        winners += (allocation > 0).sum(axis=0)
+        for bloc in labels:
+            distribution[bloc] += numpy.bincount(allocation[:, blocs == bloc].sum(axis=1), minlength=seats+1)
+    candidates = list(zip(nums, (won/simulations).tolist(), (winners/simulations).tolist()))
+    blocrows = [(bloc, n, count/simulations) for bloc in labels for n, count in enumerate(distribution[bloc].tolist())]
+    return key, candidates, blocrows
+
+def simulate_all(windows, simulations=100000, seed=0, jobs=1):
+    '''Generator of (key, candidates, blocs) as returned by simulate() for each
+    (key, nums, pct, neff, blocs, seats) in windows, in the same order
+
+    pct is the valid shares of candidates in a window and neff the effective
+    sample size; blocs is -1, 0 or 1 for each candidate. With jobs > 1,
+    windows are simulated in a pool of worker processes '''
+    tasks = (tuple(window) + (simulations, seed) for window in windows)
+    if jobs <= 1:
+        yield from map(simulate, tasks)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(simulate, tasks)
+
+if __name__ == '__main__':
+    # Benchmark: simulate the latest window of each region of a database by buildsqlite()
+    import sqlite3, sys, time
+    dbname = sys.argv[1] if len(sys.argv) > 1 else 'poll.db'
+    simulations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    regions = [("HKIsland",6),("KlnWest",6),("KlnEast",5),("NTWest",9),("NTEast",9),("SuperDC",5)]
+    cur = sqlite3.connect(dbname).cursor()
+    windows = []
+    for region, seats in regions:
+        rows = cur.execute("SELECT num, valid_adj_pct, valid_adj_neff, redness FROM overall WHERE region=? AND "
+                           "window_end=(SELECT MAX(window_end) FROM overall) AND num>0 AND num<30 AND valid_adj_pct>0 "
+                           "ORDER BY num", (region,)).fetchall()
+        nums, pct, neff, redness = zip(*rows)
+        blocs = [0 if not r else 1 if r > 0 else -1 for r in redness]
+        windows.append((region, list(nums), list(pct), neff[0], blocs, seats))
+    start = time.perf_counter()
+    for (region, _, _, _, _, seats), (_, candidates, blocs) in zip(windows, simulate_all(windows, simulations, jobs=jobs)):
+        elapsed = time.perf_counter() - start
+        expected = {bloc:sum(n*p for b, n, p in blocs if b == bloc) for bloc in (-1, 0, 1)}
+        print("%-8s %d seats, %d lists: %.2fs, expected seats by bloc %s" %
+              (region, seats, len(candidates), elapsed, " ".join("%+d:%.2f" % kv for kv in sorted(expected.items()))))
+        start = time.perf_counter()
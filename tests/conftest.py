@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Shared fixtures: the scripts are at top level of the repository, and the
+# bundled snapshots are read from there
+#
+
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+@pytest.fixture
+def repodir(monkeypatch):
+    "Run in the repository, where webscraping(use_cache=True) finds the bundled snapshots"
+    monkeypatch.chdir(REPO)
+    return REPO
+
+@pytest.fixture(scope='session')
+def polldb(tmp_path_factory):
+    "Path to a database built by buildsqlite() from the bundled snapshots"
+    from FrontlineTechWorkerRollingHelper import buildsqlite
+    dbname = str(tmp_path_factory.mktemp('db') / 'poll.db')
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        conn, _ = buildsqlite(dbname, True)
+        conn.close()
+    finally:
+        os.chdir(cwd)
+    return dbname
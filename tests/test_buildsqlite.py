@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Building and updating the database from the bundled snapshots
+#
+
+import sqlite3
+
+from FrontlineTechWorkerRollingHelper import buildsqlite
+
+def test_incremental_rebuilds_legacy_database(repodir, polldb, tmp_path):
+    # tables of a database built before the manifest was added
+    dbname = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(dbname)
+    conn.execute("CREATE TABLE answers(region,value,answer)")
+    conn.execute("CREATE TABLE redness(region,num,redness,who)")
+    conn.execute("CREATE TABLE poll(sourcefile)")
+    conn.commit()
+    conn.close()
+    conn, cur = buildsqlite(dbname, True, incremental=True)
+    expected = sqlite3.connect(polldb).execute("SELECT COUNT(*) FROM overall").fetchone()
+    assert cur.execute("SELECT COUNT(*) FROM overall").fetchone() == expected
+    assert cur.execute("SELECT COUNT(*) FROM manifest").fetchone()[0] > 0
+
+def test_incremental_rebuilds_deduplicated_database(repodir, polldb, tmp_path):
+    # tables of a database built with the dropped dedup mode
+    dbname = str(tmp_path / 'dedup.db')
+    conn = sqlite3.connect(dbname)
+    conn.execute("CREATE TABLE manifest(sourcefile PRIMARY KEY, sha256)")
+    conn.execute("CREATE TABLE respondent(rid INTEGER PRIMARY KEY, rowhash UNIQUE, master_weight)")
+    conn.execute("CREATE TABLE membership(sourcefile, respondent)")
+    conn.execute("CREATE VIEW poll AS SELECT M.*, R.* FROM membership M JOIN respondent R ON R.rid=M.respondent")
+    conn.commit()
+    conn.close()
+    conn, cur = buildsqlite(dbname, True, incremental=True)
+    expected = sqlite3.connect(polldb).execute("SELECT COUNT(*) FROM poll").fetchone()
+    assert cur.execute("SELECT COUNT(*) FROM poll").fetchone() == expected
+    assert not list(cur.execute("SELECT 1 FROM sqlite_master WHERE name IN ('respondent', 'membership')"))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Size of the chart page rendered from the bundled data, as MakeHtml.py does
+#
+
+import sqlite3
+
+import pytest
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+
+from FrontlineTechWorkerRollingHelper import PageData, Panel, QueryCache, Tabs, create_charts
+
+# chart.html of the bundled data is about 880 kB; it was over 2 MB with a
+# data source for every glyph of every candidate
+MAX_PAGE_BYTES = 1000000
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_chart_page_size(polldb, raw):
+    data = PageData(sqlite3.connect(polldb))
+    tabpanel = Tabs(tabs=[Panel(child=create_charts(data, False, raw), title="不包游離票"),
+                          Panel(child=create_charts(data, True, raw), title="包括游離票")])
+    html = file_html(tabpanel, CDN).encode('utf-8')
+    assert len(html) < MAX_PAGE_BYTES
+
+def test_charts_again_from_query_cache(polldb):
+    # as in the notebook: one QueryCache passed to every create_charts()
+    queries = QueryCache(sqlite3.connect(polldb))
+    for include_8888 in [False, True]:
+        create_charts(queries, include_8888)
+    misses = queries.misses
+    for include_8888 in [False, True]:
+        create_charts(queries, include_8888)
+    assert queries.misses == misses
+    assert queries.hits > 0
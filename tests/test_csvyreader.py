@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Reading and coercing CSVY files with csvyreader
+#
+
+import glob
+import os
+
+import colcache
+import csvyreader
+from csvyreader import Coercer, isodate, parse_all, parse_fields
+
+FIELDS = [{'name':'weight', 'class':'numeric'}, {'name':'R2', 'class':'numeric'}]
+
+def test_fields_cache_written_by_parent_only(repodir, tmp_path, monkeypatch):
+    cachefile = str(tmp_path / 'fields.json')
+    monkeypatch.setattr(csvyreader, 'FIELDS_CACHE', cachefile)
+    monkeypatch.setattr(csvyreader, '_fields_cache', {})
+    filenames = sorted(glob.glob('LC2016_final_*_v1_POP.csvy'))[:4]
+    sources = ((name, open(name, encoding='utf-8', newline='')) for name in filenames)
+    headers = []
+    for _, fields_def_yaml, _, batches in parse_all(sources, isodate, jobs=2):
+        list(batches)
+        headers.append(fields_def_yaml)
+    assert not os.path.exists(cachefile) # the workers parsed the headers in memory
+    for fields_def_yaml in headers:
+        parse_fields(fields_def_yaml)
+    assert os.path.exists(cachefile)
+    assert os.listdir(str(tmp_path)) == ['fields.json'] # no temp file left
+
+def test_numeric_type_fixed_per_column():
+    coercer = Coercer(FIELDS, ['weight', 'R2'], isodate)
+    assert coercer([['NA', ''], ['', '']]) == [(None, None), (None, None)]
+    assert coercer([['0.5', '1'], ['1', '2']]) == [(0.5, 1), (1.0, 2)]
+    batch = coercer([['1', '3'], ['2', 'NA']])
+    assert batch == [(1.0, 3), (2.0, None)]
+    assert [type(v) for v in batch[0]] == [float, int]
+
+def test_numeric_keeps_cells_not_numbers():
+    coercer = Coercer(FIELDS, ['weight', 'R2'], isodate)
+    assert coercer([['1.5', '1'], ['DK', '.'], ['2', '2.5']]) == [(1.5, 1), ('DK', '.'), (2.0, 2.5)]
+
+def test_colcache_keeps_types_of_mixed_column(tmp_path):
+    path = str(tmp_path / 'mixed.col')
+    rows = [(1,), (1.0,), ('DK',), (None,)]
+    colcache.save(path, [], ['R2'], [rows])
+    loaded = [row for batch in colcache.load(path).batches() for row in batch]
+    assert loaded == rows
+    assert [type(v) for v, in loaded] == [int, float, str, type(None)]
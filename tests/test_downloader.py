@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Fetcher and DownloadCache against a local stand-in of the HKU POP server
+#
+
+import hashlib
+import http.server
+import os
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from downloader import DownloadCache, Fetcher
+from conftest import REPO
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    '''Serve server.files by path with ETag, sleeping server.latency[path]
+    seconds first; server.failures[path] requests fail with 503 before success'''
+    def do_GET(self):
+        time.sleep(self.server.latency.get(self.path, 0))
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    "Local server of the bundled snapshots, the earlier ones slower"
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    names = sorted(f for f in os.listdir(REPO) if f.startswith('LC2016_final_') and 'master' not in f)[:8]
+    httpd.files = {}
+    for name in names:
+        with open(os.path.join(REPO, name), 'rb') as fp:
+            httpd.files['/'+name] = fp.read()
+    httpd.latency = {'/'+name: 0.02*(len(names)-n) for n, name in enumerate(names)}
+    httpd.failures = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.base = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.names = names
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_fetch_all_in_order(server):
+    urls = [server.base+'/'+name for name in server.names]
+    results = list(Fetcher(workers=4).fetch_all(urls))
+    assert [url for url, _ in results] == urls
+    for name, (_, text) in zip(server.names, results):
+        assert text.encode('utf-8') == server.files['/'+name]
+
+def test_retry_server_error(server):
+    name = '/'+server.names[0]
+    server.failures[name] = 2
+    status, _, body = Fetcher(retries=3, backoff=0.01).request(server.base+name)
+    assert status == 200 and body == server.files[name]
+    assert server.failures[name] == 0
+
+def test_not_found(server):
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        Fetcher(backoff=0.01).fetch(server.base+'/LC2016_final_missing.csvy')
+    assert excinfo.value.code == 404
+
+def test_download_cache(server, tmp_path):
+    urls = [server.base+'/'+name for name in server.names]
+    cache = DownloadCache(str(tmp_path), Fetcher(workers=4))
+    assert [text for _, text in cache.fetch_all(urls)] == [server.files['/'+n].decode('utf-8') for n in server.names]
+    assert set(cache.status.values()) == {'new'}
+    # a new run reads the index, and the server answers 304 Not Modified
+    cache = DownloadCache(str(tmp_path), Fetcher(workers=4))
+    list(cache.fetch_all(urls))
+    assert set(cache.status.values()) == {'unchanged'} and cache.changed() == []
+    changed = '/'+server.names[3]
+    server.files[changed] += b'\r\n'
+    cache = DownloadCache(str(tmp_path), Fetcher(workers=4))
+    texts = dict(cache.fetch_all(urls))
+    assert cache.changed() == [server.base+changed]
+    assert texts[server.base+changed].encode('utf-8') == server.files[changed]
+    with open(cache.filename(server.base+changed), 'rb') as fp:
+        assert fp.read() == server.files[changed]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# The queries of the charts are answered from covering indexes of
+# index_overall(), without reading the overall or ranking tables
+#
+
+import itertools
+import sqlite3
+
+import pytest
+
+from FrontlineTechWorkerRollingHelper import get_latest_date, get_rank, get_region_trends, get_trend
+
+VARIANTS = list(itertools.product([False, True], repeat=3)) # include_8888, raw, kish
+
+def plans(dbname, call):
+    "EXPLAIN QUERY PLAN of each SELECT run by call(cursor), as list of (sql, plan details)"
+    conn = sqlite3.connect(dbname)
+    statements = []
+    conn.set_trace_callback(statements.append) # with the parameters bound
+    call(conn.cursor())
+    conn.set_trace_callback(None)
+    ret = [(sql, [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)])
+           for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+    conn.close()
+    assert ret
+    return ret
+
+def assert_covering(dbname, call, index):
+    for sql, details in plans(dbname, call):
+        assert any(d.startswith("SEARCH") and "USING COVERING INDEX %s " % index in d for d in details), (sql, details)
+        assert not any(d.startswith("SCAN") for d in details), (sql, details)
+        assert not any("TEMP B-TREE" in d for d in details), (sql, details)
+
+@pytest.mark.parametrize("include_8888,raw,kish", VARIANTS)
+def test_get_trend(polldb, include_8888, raw, kish):
+    assert_covering(polldb, lambda cur: get_trend(cur, "KlnEast", 8, include_8888, raw, kish), "overall_trend")
+
+@pytest.mark.parametrize("include_8888,raw,kish", VARIANTS)
+def test_get_region_trends(polldb, include_8888, raw, kish):
+    assert_covering(polldb, lambda cur: get_region_trends(cur, "NTWest", include_8888, raw, kish), "overall_trend")
+
+@pytest.mark.parametrize("include_8888,raw,kish", VARIANTS)
+def test_get_rank(polldb, include_8888, raw, kish):
+    latest = get_latest_date(sqlite3.connect(polldb).cursor())[1]
+    assert_covering(polldb, lambda cur: get_rank(cur, "SuperDC", latest, include_8888, raw, kish), "ranking_window")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Trends over windows of other than 5 days, from the daily table
+#
+
+import os
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import REPO
+from csvyreader import isodate, parse_all
+from FrontlineTechWorkerRollingHelper import builddaily, get_region_trends, get_trend
+
+MASTER = 'LC2016_final_20160730_0902_master_v1_POP.csvy'
+
+@pytest.fixture(scope='module')
+def dailydb(polldb, tmp_path_factory):
+    '''Path to a copy of polldb with daily table by builddaily(), and the rows
+    of the master file as they are in table master'''
+    dbname = str(tmp_path_factory.mktemp('daily') / 'daily.db')
+    shutil.copy(polldb, dbname)
+    conn = sqlite3.connect(dbname)
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        builddaily(conn.cursor(), use_cache=True)
+        with open(MASTER, encoding='utf-8', newline='') as fileobj:
+            for _, _, header, batches in parse_all([(MASTER, fileobj)], isodate):
+                header = ['_'+str(n+1) if h is None else h for n,h in enumerate(header)]
+                conn.execute("CREATE TABLE master(%s)" % ",".join(header))
+                conn.executemany("INSERT INTO master VALUES(%s)" % ",".join("?"*len(header)),
+                                 (row for batch in batches for row in batch))
+    finally:
+        os.chdir(cwd)
+    conn.commit()
+    conn.close()
+    return dbname
+
+def direct_shares(cur, col, first, last, raw, include_8888):
+    "Shares of each answer in column col over the master rows dated first to last, by SUM"
+    total = "%s IS NOT NULL" % col if include_8888 else "%s>0 AND %s<30" % (col, col)
+    value = "1" if raw else "weight"
+    sql = "SELECT %s, SUM(%s)*100.0/(SELECT SUM(%s) FROM master WHERE weight IS NOT NULL AND %s " \
+          "AND date BETWEEN :first AND :last) FROM master WHERE weight IS NOT NULL AND %s IS NOT NULL " \
+          "AND date BETWEEN :first AND :last GROUP BY %s" % (col, value, value, total, col, col)
+    return dict(cur.execute(sql, dict(first=first, last=last)))
+
+def test_rolling_needs_daily_table(polldb):
+    cur = sqlite3.connect(polldb).cursor()
+    with pytest.raises(ValueError, match=r"builddaily\(\)"):
+        get_region_trends(cur, "HKIsland", days=3)
+    # the official series is read from the snapshots without it
+    assert get_region_trends(cur, "HKIsland")
+
+@pytest.mark.parametrize('region,col', [("HKIsland", "R2"), ("NTEast", "R6")])
+@pytest.mark.parametrize('days', [0, 3, 7])
+@pytest.mark.parametrize('raw,include_8888', [(True, False), (False, False), (False, True)])
+def test_rolling_against_direct_sums(dailydb, region, col, days, raw, include_8888):
+    cur = sqlite3.connect(dailydb).cursor()
+    trends = get_region_trends(cur, region, include_8888, raw, days=days)
+    assert trends
+    first, = cur.execute("SELECT MIN(date) FROM master").fetchone()
+    expected = {}
+    for num, (_, _, dates, pct, err) in trends.items():
+        assert len(dates) == len(pct) == len(err)
+        for date, share in zip(dates, pct):
+            last = date.strftime("%Y-%m-%d")
+            start = first if days == 0 else (date - timedelta(days=days-1)).strftime("%Y-%m-%d")
+            if last not in expected:
+                expected[last] = direct_shares(cur, col, start, last, raw, include_8888)
+            assert share == pytest.approx(expected[last][num], rel=1e-9)
+    # and no point is missing where the candidate has votes in the window
+    for last, shares in expected.items():
+        date = datetime.fromisoformat(last)
+        assert {num for num in shares if 0 < num < 30 or include_8888 and num == 8888} == \
+               {num for num, (_, _, dates, _, _) in trends.items() if date in dates}
+
+def test_get_trend_of_rolling_window(dailydb):
+    cur = sqlite3.connect(dailydb).cursor()
+    trends = get_region_trends(cur, "HKIsland", days=3)
+    num = next(iter(trends))
+    candid, redness, dates, pct, err = trends[num]
+    assert get_trend(cur, "HKIsland", num, days=3) == (candid, redness, [list(p) for p in zip(dates, pct, err)])
+
+def test_five_days_is_official_series(dailydb):
+    # with daily table present, 5-day windows are still read from overall
+    cur = sqlite3.connect(dailydb).cursor()
+    nums = [num for num, in cur.execute("SELECT DISTINCT num FROM overall WHERE region='HKIsland' AND num>0 AND num<30")]
+    assert nums
+    trends = get_region_trends(cur, "HKIsland", days=5)
+    assert sorted(trends) == sorted(nums)
+    for num in nums:
+        rows = list(cur.execute("SELECT window_end, candid, redness, valid_adj_pct, valid_adj_err FROM overall "
+                                "WHERE region='HKIsland' AND num=? ORDER BY window_end", (num,)))
+        candid, redness, dates, pct, err = trends[num]
+        assert (candid, redness) == rows[0][1:3]
+        assert [d.strftime("%Y-%m-%d") for d in dates] == [row[0] for row in rows]
+        assert pct == [row[3] for row in rows]
+        assert err == [row[4] for row in rows]
+        assert get_trend(cur, "HKIsland", num) == \
+               (candid, redness, [[datetime.fromisoformat(row[0]), row[3], row[4]] for row in rows])
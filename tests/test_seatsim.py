@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# vim:set ts=4 sw=4 et:
+#
+# Copyright (c) 2016 Adrian Tam & Frontline Tech Workers
+# All Rights Reserved.
+#
+# Released under 2-clause BSD license.
+#
+# Largest remainder allocation of seatsim.hare_seats()
+#
+
+import numpy
+
+from seatsim import hare_seats
+
+def reference(shares, seats):
+    "Largest remainder with Hare quota for one row of shares, ties to the earlier list"
+    quotas = (shares * (seats / shares.sum())).tolist() # same rounding as hare_seats()
+    won = [int(q) for q in quotas]
+    for n in sorted(range(len(shares)), key=lambda n: -(quotas[n]-won[n]))[:seats-sum(won)]:
+        won[n] += 1
+    return won
+
+def test_ties_give_exact_seats():
+    assert hare_seats(numpy.array([[1., 1., 1.]]), 2).tolist() == [[1, 1, 0]]
+    assert hare_seats(numpy.array([[2., 1., 1., 2.]]), 3).tolist() == [[1, 1, 0, 1]]
+
+def test_against_reference():
+    rng = numpy.random.default_rng(0)
+    shares = rng.gamma(numpy.full(10, 2.0), size=(2000, 10))
+    shares[:100] = numpy.round(shares[:100]) + 1 # whole numbers, so remainders tie
+    won = hare_seats(shares, 9)
+    assert (won.sum(axis=1) == 9).all()
+    assert won.tolist() == [reference(row, 9) for row in shares]